@@ -0,0 +1,422 @@
+"""Local stand-ins for the qBittorrent WebUI API, Transmission RPC and Deluge RPC.
+
+Each server only implements what the collectors call, backed by a synthetic
+``TorrentSet``. Every torrent listing gives some torrents new activity first, so
+incremental modes have something to patch. Run one per process so its CPU time
+doesn't show up in the exporter's numbers::
+
+    python -m benchmarks.fake_servers qbittorrent --torrents 10000
+
+The listening port is printed as ``READY <port>`` once the server accepts connections.
+"""
+import os
+import ssl
+import sys
+import json
+import time
+import zlib
+import struct
+import argparse
+import tempfile
+import threading
+import subprocess
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from benchmarks.synthetic import TorrentSet
+
+QB_STATES = {
+    "seeding": "uploading",
+    "stalled_seeding": "stalledUP",
+    "downloading": "downloading",
+    "stalled_downloading": "stalledDL",
+    "paused": "pausedUP",
+    "queued": "queuedUP",
+    "checking": "checkingUP",
+    "error": "error",
+}
+# Transmission reports states as numbers, see tr_torrent_activity
+TR_STATES = {
+    "seeding": 6,
+    "stalled_seeding": 6,
+    "downloading": 4,
+    "stalled_downloading": 4,
+    "paused": 0,
+    "queued": 5,
+    "checking": 2,
+    "error": 0,
+}
+DE_STATES = {
+    "seeding": "Seeding",
+    "stalled_seeding": "Seeding",
+    "downloading": "Downloading",
+    "stalled_downloading": "Downloading",
+    "paused": "Paused",
+    "queued": "Queued",
+    "checking": "Checking",
+    "error": "Error",
+}
+
+
+class QuietMixin:
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Collectors going away mid-request are expected, anything else is not
+        if not isinstance(sys.exc_info()[1], (ConnectionError, ssl.SSLError)):
+            super().handle_error(request, client_address)
+
+
+class HTTPServer(QuietMixin, ThreadingHTTPServer):
+    pass
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real WebUI and RPC servers
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_params(self):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        body = self.rfile.read(length) if length else b""
+        return url.path, params, body
+
+    def reply(self, status, body=b"", content_type="application/json", headers=()):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, separators=(",", ":")).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class QbittorrentHandler(JSONHandler):
+    def qb_torrent(self, t):
+        return {
+            "hash": t["hash"],
+            "name": t["name"],
+            "state": QB_STATES[t["state"]],
+            "category": t["category"],
+            "tracker": t["tracker"],
+            "size": t["size"],
+            "total_size": t["size"],
+            "progress": t["downloaded"] / t["size"],
+            "uploaded": t["uploaded"],
+            "downloaded": t["downloaded"],
+            "added_on": t["added"],
+            "last_activity": t["last_activity"],
+            "dlspeed": 0,
+            "upspeed": 0,
+        }
+
+    def server_state(self):
+        downloaded, uploaded = self.server.torrents.totals()
+        return {
+            "connection_status": "connected",
+            "dl_info_data": downloaded,
+            "up_info_data": uploaded,
+            "dl_info_speed": 1_048_576,
+            "up_info_speed": 4_194_304,
+        }
+
+    def handle_request(self):
+        path, params, body = self.read_params()
+        params.update(parse_qs(body.decode()))
+        torrents = self.server.torrents
+        if path == "/api/v2/auth/login":
+            return self.reply(200, b"Ok.", "text/plain", [("Set-Cookie", "SID=benchmark; HttpOnly; path=/")])
+        if path == "/api/v2/app/version":
+            return self.reply(200, b"v4.6.7", "text/plain")
+        if path == "/api/v2/app/webapiVersion":
+            return self.reply(200, b"2.9.3", "text/plain")
+        if path == "/api/v2/transfer/info":
+            return self.reply(200, self.server_state())
+        if path == "/api/v2/torrents/categories":
+            categories = {t["category"] for t in torrents.torrents if t["category"]}
+            return self.reply(200, {c: {"name": c, "savePath": f"/downloads/{c}"} for c in sorted(categories)})
+        if path == "/api/v2/torrents/info":
+            with self.server.lock:
+                torrents.advance()
+                return self.reply(200, [self.qb_torrent(t) for t in torrents.torrents])
+        if path == "/api/v2/sync/maindata":
+            rid = int(params.get("rid", ["0"])[0])
+            with self.server.lock:
+                tick = torrents.advance()
+                if rid <= 0 or rid >= tick:
+                    data = {
+                        "full_update": True,
+                        "torrents": {t["hash"]: self.qb_torrent(t) for t in torrents.torrents},
+                        "categories": {
+                            c: {"name": c, "savePath": f"/downloads/{c}"}
+                            for c in {t["category"] for t in torrents.torrents if t["category"]}
+                        },
+                    }
+                else:
+                    # Only the changed fields, like qBittorrent does
+                    data = {
+                        "torrents": {
+                            t["hash"]: {"uploaded": t["uploaded"], "last_activity": t["last_activity"]}
+                            for t in torrents.changed_since(rid)
+                        },
+                    }
+                data["rid"] = tick
+                data["server_state"] = self.server_state()
+                return self.reply(200, data)
+        self.reply(404, b"Not Found", "text/plain")
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+
+class TransmissionHandler(JSONHandler):
+    SESSION_ID = "benchmark-session-id"
+
+    def tr_torrent(self, t, fields):
+        torrent = {
+            "id": t["id"],
+            "hashString": t["hash"],
+            "name": t["name"],
+            "status": TR_STATES[t["state"]],
+            "labels": [t["category"]] if t["category"] else [],
+            "trackers": [{"announce": t["tracker"], "id": 0, "scrape": "", "tier": 0, "sitename": ""}],
+            "isFinished": False,
+            "isStalled": t["state"].startswith("stalled"),
+            "uploadedEver": t["uploaded"],
+            "downloadedEver": t["downloaded"],
+            "activityDate": t["last_activity"],
+            "addedDate": t["added"],
+            "totalSize": t["size"],
+            "error": 3 if t["state"] == "error" else 0,
+        }
+        return {key: torrent[key] for key in fields if key in torrent}
+
+    def session_get(self, arguments):
+        return {
+            "version": "4.0.6 (38c164933e)",
+            "rpc-version": 17,
+            "rpc-version-semver": "5.3.0",
+            "rpc-version-minimum": 14,
+            "download-dir": "/downloads",
+        }
+
+    def session_stats(self, arguments):
+        downloaded, uploaded = self.server.torrents.totals()
+        stats = {"downloadedBytes": downloaded, "uploadedBytes": uploaded, "filesAdded": 0, "secondsActive": 0, "sessionCount": 1}
+        return {
+            "activeTorrentCount": self.server.torrents.active,
+            "pausedTorrentCount": 0,
+            "torrentCount": len(self.server.torrents.torrents),
+            "downloadSpeed": 1_048_576,
+            "uploadSpeed": 4_194_304,
+            "cumulative-stats": stats,
+            "current-stats": stats,
+        }
+
+    def torrent_get(self, arguments):
+        fields = arguments.get("fields") or ["id", "name"]
+        ids = arguments.get("ids")
+        torrents = self.server.torrents
+        with self.server.lock:
+            tick = torrents.advance()
+            if ids == "recently-active":
+                changed = torrents.changed_since(self.server.last_seen)
+                self.server.last_seen = tick
+                return {"torrents": [self.tr_torrent(t, fields) for t in changed], "removed": []}
+            self.server.last_seen = tick
+            return {"torrents": [self.tr_torrent(t, fields) for t in torrents.torrents]}
+
+    def do_POST(self):
+        _, _, body = self.read_params()
+        if self.headers.get("X-Transmission-Session-Id") != self.SESSION_ID:
+            return self.reply(409, b"", "text/html", [("X-Transmission-Session-Id", self.SESSION_ID)])
+        request = json.loads(body or b"{}")
+        method = getattr(self, request.get("method", "").replace("-", "_"), None)
+        if method is None:
+            response = {"result": "method name not recognized", "arguments": {}}
+        else:
+            response = {"result": "success", "arguments": method(request.get("arguments") or {})}
+        if "tag" in request:
+            response["tag"] = request["tag"]
+        self.reply(200, response)
+
+
+RPC_RESPONSE = 1
+RPC_ERROR = 2
+DELUGE_HEADER = struct.Struct("!BI")
+
+
+class DelugeHandler(socketserver.BaseRequestHandler):
+    """Deluge 2 RPC protocol version 1: ``!BI`` header then zlib compressed rencode.
+
+    deluge_client first probes with a bare Deluge 1 message and a Deluge 2 pre-release
+    ``D`` frame. A Deluge 2 daemon drops those, so only version 1 frames get answers.
+    """
+
+    def handle(self):
+        # Only needed here, so the HTTP servers run without deluge_client
+        from deluge_client import rencode
+
+        self.rencode = rencode
+        self.sent = {}
+        buffer = b""
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            buffer += data
+            while buffer:
+                if buffer[0] in (1, ord("D")):
+                    if len(buffer) < DELUGE_HEADER.size:
+                        break
+                    version, length = DELUGE_HEADER.unpack_from(buffer)
+                    end = DELUGE_HEADER.size + length
+                    if len(buffer) < end:
+                        break
+                    frame, buffer = buffer[DELUGE_HEADER.size:end], buffer[end:]
+                    if version == 1:
+                        self.handle_frame(frame)
+                else:
+                    # Deluge 1 probe, a bare zlib stream
+                    decompressor = zlib.decompressobj()
+                    try:
+                        decompressor.decompress(buffer)
+                    except zlib.error:
+                        buffer = b""
+                        break
+                    if not decompressor.eof:
+                        break
+                    buffer = decompressor.unused_data
+
+    def handle_frame(self, frame):
+        for request_id, method, args, kwargs in self.rencode.loads(zlib.decompress(frame), decode_utf8=True):
+            handler = getattr(self, method.replace(".", "_"), None)
+            if handler is None:
+                message = (RPC_ERROR, request_id, "BadRequest", (f"Unknown method {method}",), {}, "")
+            else:
+                message = (RPC_RESPONSE, request_id, handler(*args, **kwargs))
+            body = zlib.compress(self.rencode.dumps(message))
+            self.request.sendall(DELUGE_HEADER.pack(1, len(body)) + body)
+
+    def daemon_login(self, username, password, client_version=None):
+        return 10
+
+    def daemon_info(self):
+        return "2.1.1"
+
+    def core_get_libtorrent_version(self):
+        return "2.0.10.0"
+
+    def core_get_session_status(self, keys):
+        downloaded, uploaded = self.server.torrents.totals()
+        status = {
+            "download_rate": 1_048_576.0,
+            "upload_rate": 4_194_304.0,
+            "total_download": downloaded,
+            "total_upload": uploaded,
+        }
+        return {key: status.get(key, 0) for key in keys}
+
+    def de_torrent(self, t, keys, now):
+        torrent = {
+            "name": t["name"],
+            "state": DE_STATES[t["state"]],
+            "label": t["category"],
+            "tracker": t["tracker"],
+            "total_uploaded": t["uploaded"],
+            "all_time_download": t["downloaded"],
+            "total_size": t["size"],
+            "time_added": t["added"],
+            "time_since_transfer": now - t["last_activity"],
+        }
+        return {key: torrent[key] for key in keys if key in torrent}
+
+    def core_get_torrents_status(self, filter_dict, keys, diff=False):
+        now = int(time.time())
+        torrents = self.server.torrents
+        with self.server.lock:
+            torrents.advance()
+            status = {t["hash"]: self.de_torrent(t, keys, now) for t in torrents.torrents}
+        if not diff:
+            self.sent = {}
+            return status
+        # Per connection, unchanged torrents are sent without fields
+        changes = {}
+        for torrent_hash, values in status.items():
+            previous = self.sent.get(torrent_hash, {})
+            changes[torrent_hash] = {k: v for k, v in values.items() if previous.get(k) != v}
+        self.sent = status
+        return changes
+
+
+class DelugeServer(QuietMixin, socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, address, context):
+        self.context = context
+        super().__init__(address, DelugeHandler)
+
+    def get_request(self):
+        sock, address = super().get_request()
+        return self.context.wrap_socket(sock, server_side=True), address
+
+
+def self_signed_context(directory):
+    """Deluge only speaks TLS, build a throwaway certificate with the openssl CLI."""
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+        check=True,
+        capture_output=True,
+    )
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def make_server(client: str, torrents: TorrentSet, port: int = 0, host: str = "127.0.0.1"):
+    if client == "qbittorrent":
+        server = HTTPServer((host, port), QbittorrentHandler)
+    elif client == "transmission":
+        server = HTTPServer((host, port), TransmissionHandler)
+        server.last_seen = 0
+    elif client == "deluge":
+        with tempfile.TemporaryDirectory() as directory:
+            server = DelugeServer((host, port), self_signed_context(directory))
+    else:
+        raise ValueError(f"Unsupported client: {client}")
+    server.torrents = torrents
+    server.lock = threading.Lock()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a synthetic torrent set as a fake downloader")
+    parser.add_argument("client", choices=["qbittorrent", "transmission", "deluge"])
+    parser.add_argument("--torrents", type=int, default=1000, help="Number of torrents")
+    parser.add_argument("--port", type=int, default=0, help="Port to listen on, 0 picks a free one")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic torrent set")
+    parser.add_argument("--active-fraction", type=float, default=0.01, help="Share of torrents with new activity per listing")
+    args = parser.parse_args()
+
+    server = make_server(args.client, TorrentSet(args.torrents, args.seed, args.active_fraction), args.port)
+    print(f"READY {server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
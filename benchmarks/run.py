@@ -0,0 +1,274 @@
+"""Benchmark the collectors and the whole exporter against the fake downloaders.
+
+::
+
+    python -m benchmarks.run --sizes 1000 10000 100000 --output results.json
+
+For every client, torrent count and mode (``full`` fetches every torrent on every
+scrape, ``incremental`` patches a local table) the collector is scraped in this
+process: latency and CPU time per scrape, exposition size and the tracemalloc
+peak of one scrape. Then ``main()`` is started as a subprocess with every client
+configured and scraped over HTTP, reporting its CPU time per scrape and peak RSS.
+
+The fake servers run in their own processes, so their work isn't counted.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import statistics
+import tracemalloc
+import subprocess
+import urllib.request
+from pathlib import Path
+
+import yaml
+
+ROOT = Path(__file__).resolve().parents[1]
+CLIENTS = ("qbittorrent", "transmission", "deluge")
+MODES = ("full", "incremental")
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+
+class FakeServer:
+    """A fake downloader in a subprocess, see benchmarks.fake_servers."""
+
+    def __init__(self, client: str, torrents: int, seed: int = 0):
+        self.client = client
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.fake_servers", client, "--torrents", str(torrents), "--seed", str(seed)],
+            cwd=ROOT,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        line = self.process.stdout.readline()
+        if not line.startswith("READY "):
+            self.close()
+            raise RuntimeError(f"Fake {client} server didn't start")
+        self.port = int(line.split()[1])
+
+    def config(self, **options):
+        host = {
+            "qbittorrent": f"http://127.0.0.1:{self.port}",
+            "transmission": f"http://127.0.0.1:{self.port}",
+            "deluge": f"127.0.0.1:{self.port}",
+        }[self.client]
+        return {"client": self.client, "host": host, "username": "admin", "password": "admin", **options}
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def summary(values):
+    return {
+        "min": min(values),
+        "median": statistics.median(values),
+        "mean": statistics.fmean(values),
+        "max": max(values),
+    }
+
+
+def series_count(output: bytes):
+    return sum(1 for line in output.splitlines() if line and not line.startswith(b"#"))
+
+
+def make_collector(name, config):
+    from downloader_exporter.deluge_exporter import DelugeMetricsCollector
+    from downloader_exporter.qbittorrent_exporter import QbittorrentMetricsCollector
+    from downloader_exporter.transmission_exporter import TransmissionMetricsCollector
+
+    collectors = {
+        "qbittorrent": QbittorrentMetricsCollector,
+        "transmission": TransmissionMetricsCollector,
+        "deluge": DelugeMetricsCollector,
+    }
+    return collectors[config["client"]](name=name, **config)
+
+
+def bench_collector(server, mode, torrents, iterations, options):
+    from prometheus_client import generate_latest
+    from downloader_exporter.parallel import ParallelRegistry
+
+    config = server.config(incremental=mode == "incremental", **options)
+    registry = ParallelRegistry(max_workers=1, timeout=600)
+    collector = make_collector(f"bench-{server.client}", config)
+    registry.register(collector)
+
+    # Logs in and, in incremental mode, fetches the full table
+    generate_latest(registry)
+
+    latencies, cpu_times = [], []
+    for _ in range(iterations):
+        started, cpu_started = time.perf_counter(), time.process_time()
+        output = generate_latest(registry)
+        latencies.append(time.perf_counter() - started)
+        cpu_times.append(time.process_time() - cpu_started)
+
+    tracemalloc.start()
+    try:
+        generate_latest(registry)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    collector.session.reset()
+
+    return {
+        "target": "collector",
+        "client": server.client,
+        "mode": mode,
+        "torrents": torrents,
+        "iterations": iterations,
+        "latency_seconds": summary(latencies),
+        "cpu_seconds": summary(cpu_times),
+        "exposition_bytes": len(output),
+        "series": series_count(output),
+        "peak_traced_memory_bytes": peak,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def proc_cpu_seconds(pid):
+    """utime + stime of a process, None where /proc isn't available."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def proc_peak_rss(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def scrape(url):
+    started = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=600) as response:
+        output = response.read()
+    return output, time.perf_counter() - started
+
+
+def bench_main(servers, torrents, iterations, options, exporter_args):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/metrics"
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, "config.yml")
+        with open(config_path, "w") as f:
+            yaml.safe_dump({f"bench-{s.client}": s.config(**options) for s in servers}, f)
+
+        process = subprocess.Popen(
+            [sys.executable, "-c", "from downloader_exporter.exporter import main; main()",
+             # A full 100k torrent fetch easily takes longer than the default timeout
+             "-c", config_path, "-p", str(port), "--collect-timeout", "600", *exporter_args],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            deadline = time.monotonic() + 60
+            while True:
+                try:
+                    # Also warms up the sessions
+                    scrape(url)
+                    break
+                except OSError:
+                    if process.poll() is not None or time.monotonic() > deadline:
+                        raise RuntimeError("Exporter didn't start") from None
+                    time.sleep(0.2)
+
+            latencies = []
+            cpu_started = proc_cpu_seconds(process.pid)
+            for _ in range(iterations):
+                output, latency = scrape(url)
+                latencies.append(latency)
+            cpu_ended = proc_cpu_seconds(process.pid)
+            peak_rss = proc_peak_rss(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+
+    return {
+        "target": "main",
+        "clients": [s.client for s in servers],
+        "args": list(exporter_args),
+        "torrents": torrents,
+        "iterations": iterations,
+        "latency_seconds": summary(latencies),
+        "cpu_seconds_per_scrape": None if cpu_started is None else (cpu_ended - cpu_started) / iterations,
+        "exposition_bytes": len(output),
+        "series": series_count(output),
+        "peak_rss_bytes": peak_rss,
+    }
+
+
+def exporter_version():
+    try:
+        from importlib.metadata import version
+        return version("downloader-exporter")
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark downloader-exporter against fake downloaders")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Torrent counts to benchmark")
+    parser.add_argument("--clients", nargs="+", choices=CLIENTS, default=CLIENTS)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--iterations", type=int, default=5, help="Timed scrapes per benchmark")
+    parser.add_argument("--options", type=json.loads, default={}, help="JSON object merged into every downloader config, e.g. '{\"top_torrents\": 100}'")
+    parser.add_argument("--exporter-args", default="", help="Extra arguments for the main() benchmark, e.g. '--server asyncio'")
+    parser.add_argument("--skip-main", action="store_true", help="Only benchmark the collectors")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    results = []
+    for torrents in args.sizes:
+        servers = []
+        try:
+            for client in args.clients:
+                servers.append(FakeServer(client, torrents))
+            for server in servers:
+                for mode in args.modes:
+                    print(f"{server.client} {mode} {torrents} torrents", file=sys.stderr)
+                    results.append(bench_collector(server, mode, torrents, args.iterations, args.options))
+            if not args.skip_main:
+                print(f"main() {torrents} torrents", file=sys.stderr)
+                results.append(bench_main(servers, torrents, args.iterations, args.options, args.exporter_args.split()))
+        finally:
+            for server in servers:
+                server.close()
+
+    report = json.dumps({
+        "version": exporter_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.time(),
+        "results": results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
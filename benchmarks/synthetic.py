@@ -0,0 +1,88 @@
+"""Synthetic torrent sets shared by the fake downloader servers."""
+import time
+import random
+import hashlib
+
+# (announce URL, weight), a few big trackers and a long tail like a real seedbox
+TRACKERS = [
+    ("https://tracker.alpha.example/announce", 30),
+    ("https://tracker.beta.example:2710/announce", 20),
+    ("udp://tracker.gamma.example:6969/announce", 15),
+    ("https://t1.delta.example/announce", 8),
+    ("https://t2.delta.example/announce", 8),
+    ("http://tracker.epsilon.example/announce", 5),
+] + [(f"https://tracker{i}.tail.example/announce", 1) for i in range(14)]
+
+CATEGORIES = [("movies", 30), ("tv", 30), ("music", 15), ("linux-isos", 5), ("", 20)]
+
+# Generic states, mapped to each client's own state names by the fake servers
+STATES = [
+    ("seeding", 55),
+    ("stalled_seeding", 20),
+    ("downloading", 8),
+    ("stalled_downloading", 4),
+    ("paused", 8),
+    ("queued", 2),
+    ("checking", 1),
+    ("error", 2),
+]
+
+
+def _weighted(rng, choices):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights=weights)[0]
+
+
+def generate(count: int, seed: int = 0):
+    """Return ``count`` torrents as plain dicts, always the same for a given seed."""
+    rng = random.Random(seed)
+    now = int(time.time())
+    torrents = []
+    for i in range(count):
+        size = rng.randint(50 * 2**20, 60 * 2**30)
+        state = _weighted(rng, STATES)
+        downloaded = size if "seeding" in state else rng.randint(0, size)
+        torrents.append({
+            "id": i + 1,
+            "hash": hashlib.sha1(f"{seed}-{i}".encode()).hexdigest(),
+            "name": f"Synthetic.Torrent.{i:06d}.1080p.WEB-DL",
+            "tracker": _weighted(rng, TRACKERS),
+            "category": _weighted(rng, CATEGORIES),
+            "state": state,
+            "size": size,
+            "downloaded": downloaded,
+            "uploaded": int(downloaded * rng.uniform(0, 5)),
+            "added": now - rng.randint(0, 365 * 86400),
+            "last_activity": now - rng.randint(0, 30 * 86400),
+            "changed": 0,
+        })
+    return torrents
+
+
+class TorrentSet:
+    """A torrent set where a small fraction of torrents gets activity on every tick."""
+
+    def __init__(self, count: int, seed: int = 0, active_fraction: float = 0.01):
+        self.torrents = generate(count, seed)
+        self.rng = random.Random(seed + 1)
+        self.active = max(1, int(count * active_fraction)) if count else 0
+        self.tick = 0
+
+    def advance(self):
+        """Bump the counters of some torrents, return the new tick."""
+        self.tick += 1
+        now = int(time.time())
+        for torrent in self.rng.sample(self.torrents, self.active):
+            torrent["uploaded"] += self.rng.randint(2**20, 2**28)
+            torrent["last_activity"] = now
+            torrent["changed"] = self.tick
+        return self.tick
+
+    def changed_since(self, tick: int):
+        return [t for t in self.torrents if t["changed"] > tick]
+
+    def totals(self):
+        return (
+            sum(t["downloaded"] for t in self.torrents),
+            sum(t["uploaded"] for t in self.torrents),
+        )
@@ -0,0 +1,205 @@
+import asyncio
+import threading
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from downloader_exporter.exposition import bake_output, bake_probe, bake_targets, scrape_deadline
+
+DEFAULT_MAX_REQUESTS = 64
+DEFAULT_REQUEST_TIMEOUT = 30
+DEFAULT_KEEPALIVE_TIMEOUT = 75
+# Scrapes send a handful of short headers, anything bigger isn't one
+MAX_HEADERS = 100
+MAX_REQUEST_SIZE = 64 * 1024
+
+
+class AsyncServer:
+    """Serves every listening port from a single asyncio event loop.
+
+    Connections are kept alive between requests (HTTP/1.1), at most ``max_requests``
+    requests are handled at the same time, and clients that take more than
+    ``request_timeout`` seconds to send a whole request, from its first byte, are
+    disconnected. Requests are limited to ``MAX_HEADERS`` headers and
+    ``MAX_REQUEST_SIZE`` bytes.
+
+    Downloader collection is started on the registry's own pool and awaited from the
+    loop, so waiting on slow downloaders doesn't hold a thread per request. Only the
+    rendering itself runs on the ``render_workers`` threads.
+    """
+
+    def __init__(
+        self,
+        max_requests: int = DEFAULT_MAX_REQUESTS,
+        request_timeout: float = DEFAULT_REQUEST_TIMEOUT,
+        keepalive_timeout: float = DEFAULT_KEEPALIVE_TIMEOUT,
+        render_workers: int = 4,
+    ):
+        self.max_requests = max_requests
+        self.request_timeout = request_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=render_workers, thread_name_prefix="render")
+        self._servers = {}
+        self._semaphore = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="asyncio-server", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def add_port(self, port: int, registry, addr: str = ''):
+        """Start listening on ``port``, can be called from any thread."""
+        self._call(self._listen(port, registry, addr))
+
+    def remove_port(self, port: int):
+        self._call(self._close(port))
+
+    def stop(self):
+        for port in list(self._servers):
+            self.remove_port(port)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _listen(self, port, registry, addr):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_requests)
+        server = await asyncio.start_server(
+            lambda reader, writer: self._handle(reader, writer, registry),
+            host=addr or None,
+            port=port,
+        )
+        self._servers[port] = server
+
+    async def _close(self, port):
+        server = self._servers.pop(port, None)
+        if server is not None:
+            server.close()
+            try:
+                # Newer Pythons also wait for open connections, don't let idle keep-alives hold us
+                await asyncio.wait_for(server.wait_closed(), self.request_timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _read_request(self, reader, idle_timeout):
+        try:
+            first = await asyncio.wait_for(reader.readexactly(1), idle_timeout)
+        except asyncio.IncompleteReadError:
+            return None
+        # From its first byte, the whole request has to arrive within one deadline
+        return await asyncio.wait_for(self._read_rest(reader, first), self.request_timeout)
+
+    async def _read_rest(self, reader, first):
+        request_line = first + await reader.readline()
+        size = len(request_line)
+        method, target, version = request_line.decode('latin-1').split()
+
+        headers = {}
+        for count in range(MAX_HEADERS + 1):
+            line = await reader.readline()
+            size += len(line)
+            line = line.decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            if size > MAX_REQUEST_SIZE or count == MAX_HEADERS:
+                raise ValueError("Request headers too large")
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        # Scrapes have no body, but don't let one break the next request
+        length = int(headers.get('content-length', 0) or 0)
+        if length > MAX_REQUEST_SIZE:
+            raise ValueError("Request body too large")
+        if length:
+            await reader.readexactly(length)
+        return method, target, version, headers
+
+    async def _handle(self, reader, writer, registry):
+        try:
+            timeout = self.request_timeout
+            while True:
+                request = await self._read_request(reader, timeout)
+                if request is None:
+                    break
+                method, target, version, headers = request
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+                async with self._semaphore:
+                    try:
+                        status, response_headers, body = await self._respond(registry, method, target, headers)
+                    except Exception as e:
+                        logger.error(f"Error while serving {target}: {e}")
+                        status = f"{HTTPStatus.INTERNAL_SERVER_ERROR.value} {HTTPStatus.INTERNAL_SERVER_ERROR.phrase}"
+                        response_headers, body = [('Content-Type', 'text/plain')], b'Internal Server Error'
+
+                head = [f"HTTP/1.1 {status}"]
+                head.extend(f"{key}: {value}" for key, value in response_headers)
+                head.append(f"Content-Length: {len(body)}")
+                head.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+                if method != 'HEAD':
+                    writer.write(body)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+                # Between requests, wait as long as an idle keep-alive connection is allowed to live
+                timeout = self.keepalive_timeout
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except Exception as e:
+            logger.error(f"Error while serving request: {e}")
+        finally:
+            writer.close()
+
+    async def _respond(self, registry, method, target, headers):
+        if method not in ('GET', 'HEAD'):
+            return f"{HTTPStatus.METHOD_NOT_ALLOWED.value} {HTTPStatus.METHOD_NOT_ALLOWED.phrase}", [('Allow', 'GET, HEAD')], b''
+        url = urlsplit(target)
+        if url.path == '/favicon.ico':
+            # Serve empty response for browsers
+            return '200 OK', [], b''
+        if url.path == '/targets':
+            return bake_targets(registry, headers.get('host'))
+
+        params = parse_qs(url.query)
+        deadline = scrape_deadline(headers.get('x-prometheus-scrape-timeout-seconds'), registry)
+        if url.path == '/probe':
+            try:
+                collectors = registry.targets(params.get('target') or [])
+            except KeyError:
+                collectors = []
+            await self._prefetch(registry, collectors, deadline, registry.max_age)
+            bake, args = bake_probe, (params, deadline)
+        else:
+            if hasattr(registry, 'submit'):
+                names = params.get('name[]') or params.get('name')
+                await self._prefetch(registry, registry.resolve(names), deadline)
+            bake, args = bake_output, (params, deadline)
+
+        return await self.loop.run_in_executor(
+            self._executor,
+            bake,
+            registry,
+            headers.get('accept'),
+            headers.get('accept-encoding'),
+            headers.get('if-none-match'),
+            *args,
+        )
+
+    async def _prefetch(self, registry, collectors, deadline=None, max_age=0):
+        # Wait for the downloaders here instead of in a render thread
+        futures = registry.submit(collectors, max_age).values()
+        if futures:
+            await asyncio.wait([asyncio.wrap_future(f) for f in futures], timeout=registry.remaining(futures, deadline))
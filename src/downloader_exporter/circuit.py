@@ -0,0 +1,80 @@
+import time
+import random
+
+from loguru import logger
+
+DEFAULT_CIRCUIT_FAILURES = 3
+DEFAULT_CIRCUIT_BACKOFF = 15
+DEFAULT_CIRCUIT_MAX_BACKOFF = 600
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of contacting a downloader whose circuit is open."""
+
+
+class CircuitBreaker:
+    """Stops contacting a downloader after ``failures`` consecutive failed collections.
+
+    While open, calls fail right away. Once the backoff is over, calls go through
+    again (half-open): the first success closes the circuit, a failure opens it for
+    twice as long, up to ``max_backoff`` seconds. Backoffs are jittered so that
+    downloaders which failed together aren't retried together.
+
+    Built from the downloader config with ``circuit_failures`` (0 disables it),
+    ``circuit_backoff`` and ``circuit_max_backoff``.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failures: int = DEFAULT_CIRCUIT_FAILURES,
+        backoff: float = DEFAULT_CIRCUIT_BACKOFF,
+        max_backoff: float = DEFAULT_CIRCUIT_MAX_BACKOFF,
+    ):
+        self.name = name
+        self.failures = failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._failures = 0
+        self._trips = 0
+        self._open_until = None
+
+    @classmethod
+    def from_config(cls, name: str, config: dict):
+        return cls(
+            name,
+            failures=config.get('circuit_failures', DEFAULT_CIRCUIT_FAILURES),
+            backoff=config.get('circuit_backoff', DEFAULT_CIRCUIT_BACKOFF),
+            max_backoff=config.get('circuit_max_backoff', DEFAULT_CIRCUIT_MAX_BACKOFF),
+        )
+
+    @property
+    def is_open(self):
+        return self._open_until is not None
+
+    def remaining(self):
+        """Seconds until the downloader may be contacted again."""
+        if self._open_until is None:
+            return 0
+        return max(0, self._open_until - time.monotonic())
+
+    def allow(self):
+        return self._open_until is None or time.monotonic() >= self._open_until
+
+    def success(self):
+        if self._open_until is not None:
+            logger.info(f"[{self.name}] Downloader is reachable again, closing circuit")
+        self._failures = 0
+        self._trips = 0
+        self._open_until = None
+
+    def failure(self):
+        self._failures += 1
+        # A failed half-open attempt opens the circuit again right away
+        if not self.failures or (self._open_until is None and self._failures < self.failures):
+            return
+        delay = min(self.max_backoff, self.backoff * 2 ** self._trips)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self._trips += 1
+        self._open_until = time.monotonic() + delay
+        logger.warning(f"[{self.name}] {self._failures} consecutive failures, not contacting it for {delay:.0f}s")
@@ -0,0 +1,104 @@
+from loguru import logger
+from attrdict import AttrDict
+
+from downloader_exporter.metrics import build_families
+from downloader_exporter.trackers import TrackerResolver
+from downloader_exporter.torrents import TorrentSelection, TorrentMetricsCache, TrackerTotals, DEFAULT_RATE_WINDOW, torrent_metrics
+from downloader_exporter.circuit import CircuitBreaker, CircuitOpenError
+from downloader_exporter.constants import TorrentStatus
+from downloader_exporter.instrumentation import COLLECT_DURATION, TORRENTS_PROCESSED
+
+
+def is_up(metrics):
+    return next((m["value"] for m in metrics if isinstance(m, dict) and m["name"] == "downloader_up"), False)
+
+
+class DownloaderCollector:
+    """Base of the downloader collectors, which are loaded as client plugins.
+
+    Subclasses set ``client_name`` and ``states_client`` (the client's name in
+    ``TorrentStatus``), build their session in ``create_session()`` and return the
+    metrics of one poll from ``get_metrics()``. Skipping downloaders whose circuit is
+    open, timing, error handling and labelling are done here for every client.
+    """
+
+    client_name = None
+    states_client = None
+
+    def __init__(self, name: str, host: str, username: str, password: str, **kwargs):
+        self.name = name
+        self.host = host
+        self.username = username
+        self.password = password
+        self.version = ""
+        self.session = self.create_session(CircuitBreaker.from_config(name, kwargs))
+        self.selection = TorrentSelection.from_config(kwargs)
+        self.torrent_cache = TorrentMetricsCache(kwargs.get("torrents_interval", 0))
+        self.states = TorrentStatus.states(self.states_client, kwargs.get("states"))
+        self.trackers = TrackerResolver(kwargs.get("tracker_aliases"))
+        self.tracker_totals = None
+        if kwargs.get("tracker_totals", False):
+            self.tracker_totals = TrackerTotals(kwargs.get("rate_window", DEFAULT_RATE_WINDOW))
+
+    def create_session(self, circuit: CircuitBreaker):
+        raise NotImplementedError
+
+    def get_metrics(self):
+        raise NotImplementedError
+
+    def describe(self):
+        return [AttrDict({"name": self.name, "type": "info"})]
+
+    def labels(self):
+        return {
+            "name": self.name,
+            "version": self.version,
+            "client": self.client_name,
+            "host": self.host,
+        }
+
+    def reset_version(self):
+        self.version = ""
+
+    def collect(self):
+        circuit = self.session.circuit
+        attempted = circuit.allow()
+        try:
+            if not attempted:
+                # Known to be unreachable, don't spend a thread and the scrape budget on it
+                raise CircuitOpenError()
+            with COLLECT_DURATION.labels(self.name).time():
+                metrics = self.get_metrics()
+        except Exception as e:
+            if not isinstance(e, CircuitOpenError):
+                logger.error(f"[{self.name}] Couldn't get server info: {e}")
+            self.reset_version()
+            metrics = [
+                {
+                    "name": "downloader_up",
+                    "value": False,
+                }
+            ]
+
+        if attempted:
+            # One collection counts once, however many calls the client needs for it
+            if is_up(metrics):
+                circuit.success()
+            else:
+                circuit.failure()
+                if circuit.is_open:
+                    self.session.reset()
+
+        metrics.append({
+            "name": "downloader_circuit_open",
+            "value": circuit.is_open,
+        })
+
+        yield from build_families(metrics, self.labels())
+
+    def table_metrics(self, table):
+        TORRENTS_PROCESSED.labels(self.name).inc(len(table))
+        metrics = torrent_metrics(table, self.selection)
+        if self.tracker_totals is not None:
+            metrics.extend(self.tracker_totals.metrics(table))
+        return metrics
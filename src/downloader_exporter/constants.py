@@ -1,9 +1,11 @@
+import time
 from enum import Enum
-from collections import namedtuple
 
 from loguru import logger
 
-TorrentStat = namedtuple('TorrentStat', ['status', 'category', 'tracker'])
+# Unknown states are logged at most once per client and state in this many seconds
+UNKNOWN_STATE_WARNING_INTERVAL = 600
+
 
 class TorrentStatus(Enum):
     UNKNOWN         = 'Unknown'
@@ -19,64 +21,96 @@ class TorrentStatus(Enum):
     MOVING          = 'Moving'
 
     @staticmethod
-    def parse_qb(state: str):
-        states = {
-            ('unknown'): TorrentStatus.UNKNOWN,
-            ('allocating'): TorrentStatus.ALLOCATING,
-            ('downloading', 'metaDL', 'forcedDL'): TorrentStatus.DOWNLOADING,
-            ('uploading', 'forcedUP'): TorrentStatus.UPLOADING,
-            # (): TorrentStatus.COMPLETED,
-            ('checkingUP', 'checkingDL', 'checkingResumeData'): TorrentStatus.CHECKING,
-            ('missingFiles', 'error'): TorrentStatus.ERRORED,
-            ('stalledUP', 'stalledDL'): TorrentStatus.STALLED,
-            ('queuedUP', 'allocating', 'queuedDL'): TorrentStatus.QUEUED,
-            ('pausedUP', 'pausedDL'): TorrentStatus.PAUSED,
-            ('moving'): TorrentStatus.MOVING,
-        }
-        for key, val in states.items():
-            if state in key:
-                return val
-        logger.warning(f"qBittorrent unknown state: {state}")
-        return TorrentStatus.UNKNOWN
+    def from_config(status: str):
+        """Accepts either the name or the value, in any case, e.g. ``Paused``."""
+        try:
+            return TorrentStatus[status.upper()]
+        except KeyError:
+            raise ValueError(f"Unknown torrent status: {status}") from None
+
+    @staticmethod
+    def states(client: str, overrides: dict = None):
+        """The state lookup table of a client, with the ``states`` config entries applied."""
+        table = dict(STATES[client])
+        for state, status in (overrides or {}).items():
+            table[state] = TorrentStatus.from_config(status)
+        return table
+
+    @staticmethod
+    def parse(client: str, state: str, table: dict = None):
+        status = (STATES[client] if table is None else table).get(state)
+        if status is None:
+            _warn_unknown_state(client, state)
+            return TorrentStatus.UNKNOWN
+        return status
+
+    @staticmethod
+    def parse_qb(state: str, table: dict = None):
+        return TorrentStatus.parse('qBittorrent', state, table)
 
     @staticmethod
-    def parse_de(state: str):
-        states = {
-            # (): TorrentStatus.UNKNOWN,
-            ('Allocating'): TorrentStatus.ALLOCATING,
-            ('Downloading'): TorrentStatus.DOWNLOADING,
-            ('Seeding'): TorrentStatus.UPLOADING,
-            # (): TorrentStatus.COMPLETED,
-            ('Checking'): TorrentStatus.CHECKING,
-            ('Error'): TorrentStatus.ERRORED,
-            # (): TorrentStatus.STALLED,
-            ('Queued'): TorrentStatus.QUEUED,
-            ('Paused'): TorrentStatus.PAUSED,
-            ('Moving'): TorrentStatus.MOVING,
-        }
-        for key, val in states.items():
-            if state in key:
-                return val
-        logger.warning(f"Deluge unknown state: {state}")
-        return TorrentStatus.UNKNOWN
+    def parse_de(state: str, table: dict = None):
+        return TorrentStatus.parse('Deluge', state, table)
 
     @staticmethod
-    def parse_tr(state: str):
-        states = {
-            # (): TorrentStatus.UNKNOWN,
-            # (): TorrentStatus.ALLOCATING,
-            ('downloading'): TorrentStatus.DOWNLOADING,
-            ('seeding'): TorrentStatus.UPLOADING,
-            # (): TorrentStatus.COMPLETED,
-            ('checking'): TorrentStatus.CHECKING,
-            # (): TorrentStatus.ERRORED,
-            # (): TorrentStatus.STALLED,
-            ('check pending', 'download pending', 'seed pending'): TorrentStatus.QUEUED,
-            ('stopped'): TorrentStatus.PAUSED,
-            # (): TorrentStatus.MOVING,
-        }
-        for key, val in states.items():
-            if state in key:
-                return val
-        logger.warning(f"Transmission unknown state: {state}")
-        return TorrentStatus.UNKNOWN
\ No newline at end of file
+    def parse_tr(state: str, table: dict = None):
+        return TorrentStatus.parse('Transmission', state, table)
+
+
+def _states(groups: dict):
+    return {state: status for states, status in groups.items() for state in states}
+
+
+STATES = {
+    'qBittorrent': _states({
+        ('unknown',): TorrentStatus.UNKNOWN,
+        ('allocating',): TorrentStatus.ALLOCATING,
+        ('downloading', 'metaDL', 'forcedMetaDL', 'forcedDL'): TorrentStatus.DOWNLOADING,
+        ('uploading', 'forcedUP'): TorrentStatus.UPLOADING,
+        # (): TorrentStatus.COMPLETED,
+        ('checkingUP', 'checkingDL', 'checkingResumeData'): TorrentStatus.CHECKING,
+        ('missingFiles', 'error'): TorrentStatus.ERRORED,
+        ('stalledUP', 'stalledDL'): TorrentStatus.STALLED,
+        ('queuedUP', 'queuedDL'): TorrentStatus.QUEUED,
+        # qBittorrent 5 renamed paused to stopped
+        ('pausedUP', 'pausedDL', 'stoppedUP', 'stoppedDL'): TorrentStatus.PAUSED,
+        ('moving',): TorrentStatus.MOVING,
+    }),
+    'Deluge': _states({
+        # (): TorrentStatus.UNKNOWN,
+        ('Allocating',): TorrentStatus.ALLOCATING,
+        ('Downloading',): TorrentStatus.DOWNLOADING,
+        ('Seeding',): TorrentStatus.UPLOADING,
+        # (): TorrentStatus.COMPLETED,
+        ('Checking',): TorrentStatus.CHECKING,
+        ('Error',): TorrentStatus.ERRORED,
+        # (): TorrentStatus.STALLED,
+        ('Queued',): TorrentStatus.QUEUED,
+        ('Paused',): TorrentStatus.PAUSED,
+        ('Moving',): TorrentStatus.MOVING,
+    }),
+    'Transmission': _states({
+        # (): TorrentStatus.UNKNOWN,
+        # (): TorrentStatus.ALLOCATING,
+        ('downloading',): TorrentStatus.DOWNLOADING,
+        ('seeding',): TorrentStatus.UPLOADING,
+        # (): TorrentStatus.COMPLETED,
+        ('checking',): TorrentStatus.CHECKING,
+        # (): TorrentStatus.ERRORED,
+        # (): TorrentStatus.STALLED,
+        ('check pending', 'download pending', 'seed pending'): TorrentStatus.QUEUED,
+        ('stopped',): TorrentStatus.PAUSED,
+        # (): TorrentStatus.MOVING,
+    }),
+}
+
+_unknown_states_warned = {}
+
+
+def _warn_unknown_state(client: str, state: str):
+    now = time.monotonic()
+    key = (client, state)
+    last = _unknown_states_warned.get(key)
+    if last is None or now - last >= UNKNOWN_STATE_WARNING_INTERVAL:
+        _unknown_states_warned[key] = now
+        logger.warning(f"{client} unknown state: {state}")
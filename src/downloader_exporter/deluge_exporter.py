@@ -1,100 +1,193 @@
 import time
-from urllib.parse import urlparse
-from collections import Counter
 
 from loguru import logger
-from attrdict import AttrDict
-from deluge_client import DelugeRPCClient, FailedToReconnectException
-from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from deluge_client import DelugeRPCClient
+from deluge_client.client import CallTimeoutException, ConnectionLostException, InvalidHeaderException
 
 from downloader_exporter.utils import url_parse
-from downloader_exporter.constants import TorrentStatus, TorrentStat
+from downloader_exporter.sessions import ClientSession
+from downloader_exporter.collector import DownloaderCollector
+from downloader_exporter.deluge_rpc import DelugeRemoteError, call_pipelined, supports_pipelining
+from downloader_exporter.trackers import UNKNOWN_TRACKER
+from downloader_exporter.torrents import TorrentTable
+from downloader_exporter.circuit import CircuitOpenError
+from downloader_exporter.constants import TorrentStatus
+from downloader_exporter.instrumentation import API_RESPONSE_SIZE, ERRORS
 
-DEFAULT_PORT = 58846
+DELUGE_DEFAULT_PORT = 58846
 
+TORRENT_KEYS = [
+    "state",
+    "label",
+    "tracker",
+    "total_uploaded",
+    "all_time_download",
+    "name",
+]
+STATUS_KEYS = [
+    "download_rate",
+    "upload_rate",
+    "total_download",
+    "total_upload",
+]
 
-class DelugeMetricsCollector:
-    def __init__(self, name: str, host: str, username: str, password: str, **kwargs):
-        self.name = name
-        self.host = host
-        self.username = username
-        self.password = password
-        self.version = ""
+
+class CountingSocket:
+    """Wraps the Deluge client socket to count the bytes received."""
+
+    def __init__(self, sock, session: ClientSession):
+        self._sock = sock
+        self._session = session
+
+    def recv(self, *args):
+        data = self._sock.recv(*args)
+        self._session.received(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class DelugeSession(ClientSession):
+    # deluge_client doesn't match responses to requests, after any of these the next
+    # call could read the answer of the previous one, so the connection is dropped
+    reconnect_errors = (ConnectionLostException, CallTimeoutException, InvalidHeaderException, EOFError, OSError)
+
+    def connect(self):
+        _, host, port = url_parse(self.host, DELUGE_DEFAULT_PORT)
+        client = DelugeRPCClient(
+            host=host,
+            port=port,
+            username=self.username,
+            password=self.password,
+            decode_utf8=True,
+            automatic_reconnect=False,
+        )
+        client.connect()
+        client._socket = CountingSocket(client._socket, self)
+        return client
+
+    def disconnect(self, client):
+        client.disconnect()
+
+
+class DelugeMetricsCollector(DownloaderCollector):
+    client_name = "deluge"
+    states_client = "Deluge"
+
+    def __init__(
+        self,
+        name: str,
+        host: str,
+        username: str,
+        password: str,
+        incremental: bool = False,
+        pipelining: bool = True,
+        **kwargs,
+    ):
+        self.incremental = incremental
+        self.pipelining = pipelining
         self.lt_version = ""
+        super().__init__(name, host, username, password, **kwargs)
+        self.torrent_keys = list(TORRENT_KEYS)
+        if self.selection.active_seconds:
+            # Changes on every call for every torrent, only ask for it when needed
+            self.torrent_keys.append("time_since_transfer")
+        self._torrents = {}
+        self._sync_generation = None
+        self._version_generation = None
 
-    def call(self, client, method, *args, **kwargs):
+    def call(self, method, *args, **kwargs):
         try:
-            return client.call(method, *args, **kwargs)
+            return self.session.call(method, lambda client: client.call(method, *args, **kwargs))
+        except CircuitOpenError:
+            pass
         except Exception as e:
             logger.error(
                 f"[{self.name}] Cannot connect to deluge client {self.name}, method: {method}: {e}"
             )
         return ""
 
-    @property
-    def client(self):
-        _, host, port = url_parse(self.host)
-        return DelugeRPCClient(
-            host=host,
-            port=port,
-            username=self.username,
-            password=self.password,
-            decode_utf8=True,
-        )
+    def create_session(self, circuit):
+        return DelugeSession(self.name, self.host, self.username, self.password, circuit=circuit)
 
-    def describe(self):
-        return [AttrDict({"name": self.name, "type": "info"})]
-
-    def collect(self):
-        metrics = self.get_metrics()
-
-        for metric in metrics:
-            name = metric["name"]
-            value = metric["value"]
-            help_text = metric.get("help", "")
-            labels = {
-                **metric.get("labels", {}),
-                **{
-                    "name": self.name,
-                    "version": self.version,
-                    "lt_version": self.lt_version,
-                    "client": "deluge",
-                    "host": self.host,
-                },
-            }
-            metric_type = metric.get("type", "gauge")
-
-            if metric_type == "counter":
-                prom_metric = CounterMetricFamily(name, help_text, labels=labels.keys())
-            else:
-                prom_metric = GaugeMetricFamily(name, help_text, labels=labels.keys())
-            prom_metric.add_metric(value=value, labels=labels.values())
-            yield prom_metric
+    def labels(self):
+        return {
+            "name": self.name,
+            "version": self.version,
+            "lt_version": self.lt_version,
+            "client": self.client_name,
+            "host": self.host,
+        }
+
+    def reset_version(self):
+        self.version = self.lt_version = ""
+        self._version_generation = None
 
     def get_metrics(self):
+        # The versions can only change if the daemon was restarted, which means a reconnect
+        fetch_version = self._version_generation != self.session.generation
+        full = self._sync_generation != self.session.generation
+        calls = []
+        if fetch_version:
+            calls.append(("daemon.info", (), {}))
+            calls.append(("core.get_libtorrent_version", (), {}))
+        calls.append(("core.get_session_status", (STATUS_KEYS,), {}))
+        scan_torrents = self.torrent_cache.due()
+        if scan_torrents:
+            if self.incremental:
+                calls.append(("core.get_torrents_status", ({}, self.torrent_keys), {"diff": not full}))
+            else:
+                calls.append(("core.get_torrents_status", ({}, self.torrent_keys), {}))
+
+        results = self.call_many(calls)
+        if scan_torrents:
+            *results, torrents = results
+        status = results[-1]
+        if fetch_version:
+            self.version, self.lt_version = results[0], results[1]
+            # A failed call leaves a version empty, ask again on the next poll
+            if self.version and self.lt_version:
+                self._version_generation = self.session.generation
+        if not status:
+            self.reset_version()
+
         metrics = []
-        with self.client as client:
-            metrics.extend(self.get_status_metrics(client))
-            metrics.extend(self.get_torrent_metrics(client))
+        metrics.extend(self.get_status_metrics(status))
+        if scan_torrents:
+            self.torrent_cache.store(self.get_torrent_metrics(self.sync(torrents, full) if self.incremental else torrents))
+        metrics.extend(self.torrent_cache.metrics)
         return metrics
 
-    def get_status_metrics(self, client):
-        self.version = self.call(client, "daemon.info")
-        if self.version:
-            self.version = self.version
-        self.lt_version = self.call(client, "core.get_libtorrent_version")
-        if self.lt_version:
-            self.lt_version = self.lt_version
-        status = self.call(
-            client,
-            "core.get_session_status",
-            [
-                "download_rate",
-                "upload_rate",
-                "total_download",
-                "total_upload",
-            ],
-        )
+    def call_many(self, calls):
+        """Results of ``(method, args, kwargs)`` calls, "" for the ones which failed.
+
+        With pipelining, all of them are sent at once and cost a single round-trip, timed
+        as the ``pipeline`` call. Response sizes are still recorded per method.
+        """
+        if self.pipelining:
+            observe_size = lambda method, size: API_RESPONSE_SIZE.labels(self.name, method).observe(size)
+            try:
+                results = self.session.call(
+                    "pipeline",
+                    lambda client: call_pipelined(client, calls, observe_size) if supports_pipelining(client) else None,
+                )
+            except CircuitOpenError:
+                return [""] * len(calls)
+            except Exception as e:
+                logger.error(f"[{self.name}] Cannot connect to deluge client {self.name}: {e}")
+                return [""] * len(calls)
+            if results is not None:
+                for (method, _, _), result in zip(calls, results):
+                    if isinstance(result, DelugeRemoteError):
+                        logger.error(f"[{self.name}] Deluge call failed, method: {method}: {result}")
+                        ERRORS.labels(self.name, method).inc()
+                return ["" if isinstance(result, DelugeRemoteError) else result for result in results]
+            logger.info(f"[{self.name}] Daemon doesn't support pipelining, sending calls one by one")
+            self.pipelining = False
+        return [self.call(method, *args, **kwargs) for method, args, kwargs in calls]
+
+    def get_status_metrics(self, status):
         if not status:
             status = {}
 
@@ -102,89 +195,62 @@ class DelugeMetricsCollector:
             {
                 "name": "downloader_up",
                 "value": bool(status),
-                "help": "Whether if server is alive or not",
             },
             {
                 "name": "downloader_download_bytes_total",
                 "value": status.get("total_download", 0),
-                "help": "Data downloaded this session (bytes)",
-                "type": "counter",
             },
             {
                 "name": "downloader_download_speed_bytes",
                 "value": status.get("download_rate", 0),
-                "help": "Data download speed (bytes)",
             },
             {
                 "name": "downloader_upload_bytes_total",
                 "value": status.get("total_upload", 0),
-                "help": "Data uploaded this session (bytes)",
-                "type": "counter",
             },
             {
                 "name": "downloader_upload_speed_bytes",
                 "value": status.get("upload_rate", 0),
-                "help": "Data upload speed (bytes)",
             },
         ]
 
-    def get_torrent_metrics(self, client):
-        torrents = self.call(
-            client,
-            "core.get_torrents_status",
-            {},
-            ["state", "label", "tracker", "total_uploaded", "all_time_download", "name"],
-        )
+    def sync(self, torrents, full):
+        """Patch the local torrent table with the fields changed since the last call.
+
+        Deluge remembers what it sent per connection, so the diff is only meaningful
+        on the connection which got the previous answer.
+        """
+        if not isinstance(torrents, dict):
+            self._sync_generation = None
+            return {}
+
+        if full:
+            self._torrents = torrents
+        else:
+            # Every torrent is listed, unchanged ones with no fields, removed ones not at all
+            for torrent_hash in self._torrents.keys() - torrents.keys():
+                del self._torrents[torrent_hash]
+            for torrent_hash, val in torrents.items():
+                self._torrents.setdefault(torrent_hash, {}).update(val)
+        self._sync_generation = self.session.generation
+        return self._torrents
+
+    def get_torrent_metrics(self, torrents):
         if not torrents:
             return []
-        counter = Counter()
-        metrics = []
+        now = time.time()
+        table = TorrentTable()
         for torrent_hash, val in torrents.items():
-            tracker = urlparse(val.get("tracker", "https://unknown.tracker")).netloc
-            counter[
-                TorrentStat(
-                    TorrentStatus.parse_de(val.get("state", "")).value,
-                    val.get("label", "Uncategorized"),
-                    tracker,
-                )
-            ] += 1
-            torrent_name = val.get("name", "unknown")
-            metrics.append(
-                {
-                    "name": "downloader_tracker_torrent_upload_bytes_total",
-                    "type": "counter",
-                    "value": val.get("total_uploaded", 0.0),
-                    "labels": {
-                        "torrent_name": torrent_name,
-                        "tracker": tracker,
-                    },
-                    "help": f"Data uploaded to tracker {tracker} for torrent {torrent_name}",
-                }
-            )
-            metrics.append(
-                {
-                    "name": "downloader_tracker_torrent_download_bytes_total",
-                    "type": "counter",
-                    "value": val.get("all_time_download", 0.0),
-                    "labels": {
-                        "torrent_name": torrent_name,
-                        "tracker": tracker,
-                    },
-                    "help": f"Data downloaded to tracker {tracker} for torrent {torrent_name}",
-                }
+            # Deluge 1.x doesn't know time_since_transfer
+            since_transfer = val.get("time_since_transfer")
+            table.append(
+                val.get("name", "unknown"),
+                TorrentStatus.parse_de(val.get("state", ""), self.states).value,
+                val.get("label", "Uncategorized"),
+                self.trackers.resolve(val.get("tracker", UNKNOWN_TRACKER)),
+                val.get("total_uploaded", 0),
+                val.get("all_time_download", 0),
+                now - since_transfer if since_transfer is not None else None,
+                torrent_hash,
             )
-
-        for t, count in counter.items():
-            metrics.append(
-                {
-                    "name": "downloader_torrents_count",
-                    "value": count,
-                    "labels": {
-                        "status": t.status,
-                        "category": t.category,
-                        "tracker": t.tracker,
-                    },
-                    "help": f"Number of torrents in status {t.status} under category {t.category} with tracker {t.tracker}",
-                }
-            )
-        return metrics
+        return self.table_metrics(table)
@@ -0,0 +1,80 @@
+import zlib
+import struct
+
+from deluge_client import rencode
+
+RPC_RESPONSE = 1
+RPC_ERROR = 2
+RPC_EVENT = 3
+# Deluge 2 frames every message with the protocol version and the body length
+HEADER = struct.Struct("!BI")
+PROTOCOL_VERSION = 1
+READ_SIZE = 64 * 1024
+
+
+class DelugeRemoteError(Exception):
+    """The daemon answered one of the pipelined calls with an error."""
+
+
+def supports_pipelining(client):
+    """Only the framed Deluge 2 protocol lets responses be told apart on the wire."""
+    return (
+        getattr(client, "deluge_version", None) == 2
+        and getattr(client, "deluge_protocol_version", None) == PROTOCOL_VERSION
+    )
+
+
+def _recv(sock):
+    data = sock.recv(READ_SIZE)
+    if not data:
+        raise EOFError("Connection closed by the daemon")
+    return data
+
+
+def call_pipelined(client, calls, observe_size=None):
+    """Send every ``(method, args, kwargs)`` in one burst, return the results in order.
+
+    Uses the socket of a connected, logged in ``DelugeRPCClient``. Responses are
+    matched to their call by request id, whatever order the daemon answers in, and
+    calls answered with an error get a DelugeRemoteError in their place.
+    ``observe_size(method, size)`` is called with the size of each response.
+    """
+    request_ids = []
+    methods = {}
+    payload = []
+    for method, args, kwargs in calls:
+        client.request_id += 1
+        request_ids.append(client.request_id)
+        methods[client.request_id] = method
+        body = zlib.compress(rencode.dumps(((client.request_id, method, args, kwargs),)))
+        payload.append(HEADER.pack(PROTOCOL_VERSION, len(body)))
+        payload.append(body)
+    sock = client._socket
+    sock.sendall(b"".join(payload))
+
+    results = {}
+    pending = set(request_ids)
+    buffer = bytearray()
+    while pending:
+        while len(buffer) < HEADER.size:
+            buffer += _recv(sock)
+        _, length = HEADER.unpack_from(buffer)
+        end = HEADER.size + length
+        while len(buffer) < end:
+            buffer += _recv(sock)
+        message = rencode.loads(zlib.decompress(buffer[HEADER.size:end]), decode_utf8=client.decode_utf8)
+        del buffer[:end]
+
+        # Events have no request id, and nothing else is waiting on this connection
+        if message[0] == RPC_EVENT or message[1] not in pending:
+            continue
+        msg_type, request_id = message[0], message[1]
+        pending.discard(request_id)
+        if observe_size is not None:
+            observe_size(methods[request_id], end)
+        if msg_type == RPC_RESPONSE:
+            results[request_id] = message[2]
+        else:
+            exception_type, exception_args = message[2], message[3]
+            results[request_id] = DelugeRemoteError(f"{exception_type}: {', '.join(map(str, exception_args))}")
+    return [results[request_id] for request_id in request_ids]
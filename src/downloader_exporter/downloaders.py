@@ -0,0 +1,230 @@
+import os
+import time
+import threading
+
+import yaml
+from loguru import logger
+
+from downloader_exporter.instrumentation import InstrumentationCollector
+from downloader_exporter.poller import BackgroundCollector, DEFAULT_REFRESH_INTERVAL
+from downloader_exporter.state import fingerprint
+from downloader_exporter.plugins import load_client
+
+
+def load_config(path: str):
+    with open(path, 'r') as f:
+        return yaml.safe_load(f) or {}
+
+
+class ConfigWatcher:
+    """Tells when the config file changed on disk, by polling its mtime and size."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._stat = self._read()
+
+    def _read(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            # Editors often replace the file, it's back on the next poll
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def changed(self):
+        stat = self._read()
+        if stat is None or stat == self._stat:
+            return False
+        self._stat = stat
+        return True
+
+
+class Downloader:
+    def __init__(self, name: str, config: dict, collector, registry, port: int = None):
+        self.name = name
+        self.config = config
+        self.collector = collector
+        self.registry = registry
+        self.port = port
+
+
+def close_collector(collector):
+    if isinstance(collector, BackgroundCollector):
+        collector.stop()
+        collector = collector.collector
+    collector.session.reset()
+
+
+class Downloaders:
+    """The running collectors, kept in line with the config on every (re)load.
+
+    ``apply()`` only touches the downloaders whose config entry was added, removed or
+    changed. The others keep their collector, with its connection and caches, and in
+    ``--multi`` mode their port. A changed downloader keeps its port too, a new one
+    gets the first free port from ``port`` on.
+
+    Scrapes are never blocked: registries are only locked to swap a collector, and a
+    scrape already running finishes with the collectors it started with.
+    """
+
+    def __init__(
+        self,
+        registry,
+        serve,
+        close_port,
+        new_registry,
+        multi: bool = False,
+        port: int = 9000,
+        background: bool = False,
+        refresh_interval: float = DEFAULT_REFRESH_INTERVAL,
+        shard=None,
+    ):
+        self.registry = registry
+        self.serve = serve
+        self.close_port = close_port
+        self.new_registry = new_registry
+        self.multi = multi
+        self.port = port
+        self.background = background
+        self.refresh_interval = refresh_interval
+        self.shard = shard
+        self.running = {}
+        self._lock = threading.Lock()
+
+    def _build(self, name, config):
+        client = config.get('client')
+        collector_class = load_client(client)
+        if collector_class is None:
+            logger.warning(f"Unsupported client: {client}, config: {config}")
+            return None
+        collector = collector_class(name=name, **config)
+        if self.background:
+            interval = config.get('status_interval', config.get('refresh_interval', self.refresh_interval))
+            collector = BackgroundCollector(collector, interval=interval)
+            collector.start()
+        return collector
+
+    def _free_port(self):
+        used = {downloader.port for downloader in self.running.values()}
+        port = self.port
+        while port in used:
+            port += 1
+        return port
+
+    def _add(self, name, config, collector):
+        if not self.multi:
+            logger.info(f"Registering {name}")
+            self.registry.register(collector)
+            self.running[name] = Downloader(name, config, collector, self.registry)
+            return
+
+        port = self._free_port()
+        logger.info(f"Registering {name} at port {port}")
+        registry = self.new_registry()
+        registry.register(collector)
+        registry.register(InstrumentationCollector([name]))
+        try:
+            self.serve(port, registry)
+        except OSError as e:
+            logger.error(f"[{name}] Can't listen on port {port}: {e}")
+            close_collector(collector)
+            registry.close()
+            return
+        self.running[name] = Downloader(name, config, collector, registry, port)
+
+    def _replace(self, downloader, config, collector):
+        logger.info(f"Reloading {downloader.name}")
+        downloader.registry.unregister(downloader.collector)
+        downloader.registry.register(collector)
+        close_collector(downloader.collector)
+        downloader.config = config
+        downloader.collector = collector
+
+    def _remove(self, name):
+        downloader = self.running.pop(name)
+        logger.info(f"Unregistering {name}")
+        downloader.registry.unregister(downloader.collector)
+        if downloader.port is not None:
+            self.close_port(downloader.port)
+            # Every --multi port has its own registry and worker threads
+            downloader.registry.close()
+        close_collector(downloader.collector)
+
+    def apply(self, config: dict):
+        if self.shard is not None and self.shard.count > 1:
+            config = self.shard.select(config)
+        with self._lock:
+            for name in [name for name in self.running if name not in config]:
+                self._remove(name)
+
+            for name, c in config.items():
+                downloader = self.running.get(name)
+                if downloader is not None and downloader.config == c:
+                    continue
+                try:
+                    collector = self._build(name, c)
+                except Exception as e:
+                    logger.error(f"[{name}] Invalid config, keeping the previous one: {e}")
+                    continue
+                if collector is None:
+                    if downloader is not None:
+                        self._remove(name)
+                elif downloader is None:
+                    self._add(name, c, collector)
+                else:
+                    self._replace(downloader, c, collector)
+
+    def names(self):
+        with self._lock:
+            return list(self.running)
+
+    def snapshot(self):
+        """The last metrics of every downloader, as ``{name: (fingerprint, collected, metrics)}``."""
+        snapshots = {}
+        with self._lock:
+            downloaders = list(self.running.values())
+        for downloader in downloaders:
+            collector = downloader.collector
+            if isinstance(collector, BackgroundCollector):
+                snapshot = collector.snapshot
+                result = (snapshot.metrics, snapshot.timestamp) if snapshot.timestamp else None
+            else:
+                result = downloader.registry.last_result(collector)
+            if result is not None:
+                snapshots[downloader.name] = (fingerprint(downloader.config), result[1], result[0])
+        return snapshots
+
+    def restore(self, snapshots):
+        """Seed the downloaders with saved metrics, see ``snapshot()``.
+
+        Metrics saved for another config of the downloader, or older than the
+        registry's ``stale_max_age``, are left out.
+        """
+        restored = 0
+        with self._lock:
+            for name, (config_fingerprint, collected, metrics) in snapshots.items():
+                downloader = self.running.get(name)
+                if downloader is None or fingerprint(downloader.config) != config_fingerprint:
+                    continue
+                if not 0 <= time.time() - collected <= downloader.registry.stale_max_age:
+                    continue
+                if isinstance(downloader.collector, BackgroundCollector):
+                    downloader.collector.restore(metrics, collected)
+                else:
+                    downloader.registry.restore(downloader.collector, metrics, collected)
+                restored += 1
+        if restored:
+            logger.info(f"Restored the saved state of {restored} downloaders")
+
+    def reload(self, path: str):
+        """Re-read the config file, a broken file leaves everything as it is."""
+        logger.info(f"Reloading config from {path}")
+        try:
+            config = load_config(path)
+        except (OSError, yaml.YAMLError) as e:
+            logger.error(f"Can't reload config: {e}")
+            return
+        if not isinstance(config, dict):
+            logger.error(f"Can't reload config: expected a mapping of downloaders, got {type(config).__name__}")
+            return
+        self.apply(config)
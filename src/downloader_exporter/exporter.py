@@ -1,81 +1,24 @@
 import time
-import os
-import sys
 import signal
 import argparse
 import threading
 import faulthandler
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
 from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
 
-try:
-    from urllib import quote_plus
-
-    from BaseHTTPServer import BaseHTTPRequestHandler
-    from SocketServer import ThreadingMixIn
-    from urllib2 import (
-        build_opener, HTTPError, HTTPHandler, HTTPRedirectHandler, Request,
-    )
-    from urlparse import parse_qs, urlparse
-except ImportError:
-    # Python 3
-    from http.server import BaseHTTPRequestHandler
-    from socketserver import ThreadingMixIn
-    from urllib.error import HTTPError
-    from urllib.parse import parse_qs, quote_plus, urlparse
-    from urllib.request import (
-        build_opener, HTTPHandler, HTTPRedirectHandler, Request,
-    )
-
-import yaml
 from loguru import logger
-from prometheus_client import start_http_server, Metric, generate_latest, CONTENT_TYPE_LATEST, make_wsgi_app as old_make_wsgi_app
-from prometheus_client.core import REGISTRY, CollectorRegistry
-from prometheus_client.openmetrics import exposition as openmetrics
-
-from downloader_exporter.deluge_exporter import DelugeMetricsCollector
-from downloader_exporter.qbittorrent_exporter import QbittorrentMetricsCollector
-from downloader_exporter.transmission_exporter import TransmissionMetricsCollector
-
-def restricted_registry(self, names):
-    names = set(names)
-    collectors = set()
-    metrics = []
-    with self._lock:
-        if 'target_info' in names and self._target_info:
-            metrics.append(self._target_info_metric())
-            names.remove('target_info')
-        for name in names:
-            if name in self._names_to_collectors:
-                collectors.add(self._names_to_collectors[name])
-    for collector in collectors:
-        for metric in collector.collect():
-            metrics.append(metric)
-
-    class RestrictedRegistry(object):
-        def collect(self):
-            return metrics
-
-    return RestrictedRegistry()
-        
-
-# Monkey patch restricted_registry
-CollectorRegistry.restricted_registry = restricted_registry
-
-def choose_encoder(accept_header):
-    accept_header = accept_header or ''
-    for accepted in accept_header.split(','):
-        if accepted.split(';')[0].strip() == 'application/openmetrics-text':
-            return (openmetrics.generate_latest,
-                    openmetrics.CONTENT_TYPE_LATEST)
-    return generate_latest, CONTENT_TYPE_LATEST
-
-def bake_output(registry, accept_header, params):
-    """Bake output for metrics output."""
-    encoder, content_type = choose_encoder(accept_header)
-    if 'name' in params:
-        registry = registry.restricted_registry(params['name'])
-    output = encoder(registry)
-    return str('200 OK'), (str('Content-Type'), content_type), output
+from prometheus_client import PROCESS_COLLECTOR, PLATFORM_COLLECTOR, GC_COLLECTOR
+from prometheus_client.core import REGISTRY
+
+from downloader_exporter.exposition import bake_output, bake_probe, bake_targets, scrape_deadline, EXPOSITION_CACHE, DEFAULT_CACHE_MAX_AGE
+from downloader_exporter.aio_server import AsyncServer, DEFAULT_MAX_REQUESTS
+from downloader_exporter.instrumentation import InstrumentationCollector
+from downloader_exporter.poller import DEFAULT_REFRESH_INTERVAL
+from downloader_exporter.parallel import ParallelRegistry, DEFAULT_CONCURRENCY, DEFAULT_COLLECT_TIMEOUT, DEFAULT_PROBE_MAX_AGE, DEFAULT_STALE_MAX_AGE
+from downloader_exporter.downloaders import Downloaders, ConfigWatcher, load_config
+from downloader_exporter.state import StateFile, DEFAULT_STATE_INTERVAL
+from downloader_exporter.shard import Shard, ShardCollector
 
 
 def make_wsgi_app(registry=REGISTRY):
@@ -83,17 +26,25 @@ def make_wsgi_app(registry=REGISTRY):
     def prometheus_app(environ, start_response):
         # Prepare parameters
         accept_header = environ.get('HTTP_ACCEPT')
+        accept_encoding = environ.get('HTTP_ACCEPT_ENCODING')
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        deadline = scrape_deadline(environ.get('HTTP_X_PROMETHEUS_SCRAPE_TIMEOUT_SECONDS'), registry)
         params = parse_qs(environ.get('QUERY_STRING', ''))
         if environ['PATH_INFO'] == '/favicon.ico':
             # Serve empty response for browsers
             status = '200 OK'
-            header = ('', '')
+            headers = []
             output = b''
+        elif environ['PATH_INFO'] == '/targets':
+            host = environ.get('HTTP_HOST') or f"{environ['SERVER_NAME']}:{environ['SERVER_PORT']}"
+            status, headers, output = bake_targets(registry, host)
+        elif environ['PATH_INFO'] == '/probe':
+            status, headers, output = bake_probe(registry, accept_header, accept_encoding, if_none_match, params, deadline)
         else:
             # Bake output
-            status, header, output = bake_output(registry, accept_header, params)
+            status, headers, output = bake_output(registry, accept_header, accept_encoding, if_none_match, params, deadline)
         # Return output
-        start_response(status, [header])
+        start_response(status, headers)
         return [output]
 
     return prometheus_app
@@ -121,6 +72,7 @@ def start_wsgi_server(port, addr='', registry=REGISTRY):
     t = threading.Thread(target=httpd.serve_forever)
     t.daemon = True
     t.start()
+    return httpd
 
 # Enable dumps on stderr in case of segfault
 faulthandler.enable()
@@ -128,63 +80,137 @@ faulthandler.enable()
 class SignalHandler():
     def __init__(self):
         self.shutdown = False
+        self.reload = False
 
         # Register signal handler
         signal.signal(signal.SIGINT, self._on_signal_received)
         signal.signal(signal.SIGTERM, self._on_signal_received)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._on_reload_received)
 
     def is_shutting_down(self):
         return self.shutdown
 
+    def should_reload(self):
+        reload, self.reload = self.reload, False
+        return reload
+
     def _on_signal_received(self, signal, frame):
         logger.info("Exporter is shutting down")
         self.shutdown = True
 
+    def _on_reload_received(self, signal, frame):
+        # Only flagged here, the main loop reloads outside of the signal handler
+        self.reload = True
+
 
 def main():
     parser = argparse.ArgumentParser(description='BT clients stats exporter.')
     parser.add_argument('-c', '--config', help='The path to config file', default='/config/config.yml')
     parser.add_argument('-p', '--port', type=int, help='The port to use', default=9000)
     parser.add_argument('--multi', action="store_true", help='Use different ports for each exporter')
+    parser.add_argument('--background', action="store_true", help='Poll downloaders in background and serve the latest snapshot on scrape')
+    parser.add_argument('--refresh-interval', type=float, help='Default background polling interval in seconds', default=DEFAULT_REFRESH_INTERVAL)
+    parser.add_argument('--concurrency', type=int, help='How many downloaders to collect at the same time', default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--server', choices=['wsgi', 'asyncio'], help='HTTP server implementation', default='wsgi')
+    parser.add_argument('--max-requests', type=int, help='Maximum concurrent requests with the asyncio server', default=DEFAULT_MAX_REQUESTS)
+    parser.add_argument('--cache-max-age', type=float, help='Seconds a rendered output can be reused while data is unchanged', default=DEFAULT_CACHE_MAX_AGE)
+    parser.add_argument('--collect-timeout', type=float, help='Seconds to wait for a downloader before reporting it as down', default=DEFAULT_COLLECT_TIMEOUT)
+    parser.add_argument('--probe-max-age', type=float, help='Seconds a /probe result can be reused for the same target', default=DEFAULT_PROBE_MAX_AGE)
+    parser.add_argument('--scrape-timeout', type=float, help='Seconds a scrape may take when Prometheus doesn\'t send its scrape timeout', default=None)
+    parser.add_argument('--stale-max-age', type=float, help='Serve data up to this old for downloaders that miss the scrape deadline, 0 to disable', default=DEFAULT_STALE_MAX_AGE)
+    parser.add_argument('--watch-config', action="store_true", help='Reload the config file when it changes, SIGHUP always reloads it')
+    parser.add_argument('--state-file', help='Save the last metrics of every downloader to this file and serve them while restarting', default=None)
+    parser.add_argument('--state-interval', type=float, help='Seconds between two saves of the state file', default=DEFAULT_STATE_INTERVAL)
+    parser.add_argument('--shard-index', type=int, help='Index of this replica, it only collects the downloaders it owns', default=0)
+    parser.add_argument('--shard-count', type=int, help='Number of replicas sharing the config', default=1)
     args = parser.parse_args()
+    try:
+        shard = Shard(args.shard_index, args.shard_count)
+    except ValueError as e:
+        parser.error(str(e))
 
-    with open(args.config, 'r') as f:
-        config = yaml.safe_load(f)
+    config = load_config(args.config)
 
     # Register signal handler
     signal_handler = SignalHandler()
 
+    EXPOSITION_CACHE.max_age = args.cache_max_age
+
+    if args.server == 'asyncio':
+        server = AsyncServer(max_requests=args.max_requests)
+        server.start()
+        serve = lambda port, registry: server.add_port(port, registry)
+        close_port = server.remove_port
+        stop_server = server.stop
+    else:
+        servers = {}
+
+        def serve(port, registry):
+            servers[port] = start_wsgi_server(port, registry=registry)
+
+        def close_port(port):
+            httpd = servers.pop(port)
+            httpd.shutdown()
+            httpd.server_close()
+
+        def stop_server():
+            for port in list(servers):
+                close_port(port)
+
+    def new_registry(max_workers=1):
+        registry = ParallelRegistry(
+            max_workers=max_workers,
+            timeout=args.collect_timeout,
+            max_age=args.probe_max_age,
+            stale_max_age=args.stale_max_age,
+            scrape_timeout=args.scrape_timeout,
+        )
+        if shard.count > 1:
+            registry.register(ShardCollector(shard, registry))
+        return registry
+
+    registry = new_registry(args.concurrency)
+    for default_collector in (PROCESS_COLLECTOR, PLATFORM_COLLECTOR, GC_COLLECTOR, InstrumentationCollector()):
+        registry.register(default_collector)
+
     # Register our custom collector
-    counter = 0
     logger.info("Exporter is starting up")
-    for name, c in config.items():
-        client = c.get('client')
-        if client == 'qbittorrent':
-            collector = QbittorrentMetricsCollector(name=name, **c)
-        elif client == 'deluge':
-            collector=DelugeMetricsCollector(name=name, **c)
-        elif client == 'transmission':
-            collector=TransmissionMetricsCollector(name=name, **c)
-        else:
-            logger.warning(f"Unsupported client: {client}, config: {c}")
-            continue
+    downloaders = Downloaders(
+        registry,
+        serve,
+        close_port,
+        new_registry,
+        multi=args.multi,
+        port=args.port,
+        background=args.background,
+        refresh_interval=args.refresh_interval,
+        shard=shard,
+    )
+    downloaders.apply(config)
+    watcher = ConfigWatcher(args.config) if args.watch_config else None
 
-        if args.multi:
-            logger.info(f"Registering {name} at port {args.port+counter}")
-            start_http_server(args.port+counter, registry=collector)
-        else:
-            logger.info(f"Registering {name}")
-            REGISTRY.register(collector)
-        counter += 1
+    state = StateFile(args.state_file) if args.state_file else None
+    if state is not None:
+        downloaders.restore(state.load())
+    next_save = time.monotonic() + args.state_interval
 
     # Start server
     if not args.multi:
-        start_wsgi_server(args.port, registry=REGISTRY)
+        serve(args.port, registry)
         logger.info(f"Exporter listening on port {args.port}")
 
     while not signal_handler.is_shutting_down():
         time.sleep(1)
-
+        if signal_handler.should_reload() or (watcher is not None and watcher.changed()):
+            downloaders.reload(args.config)
+        if state is not None and time.monotonic() >= next_save:
+            state.save(downloaders.snapshot(), downloaders.names())
+            next_save = time.monotonic() + args.state_interval
+
+    if state is not None:
+        state.save(downloaders.snapshot(), downloaders.names())
+    stop_server()
     logger.info("Exporter has shutdown")
 
 
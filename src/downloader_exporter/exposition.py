@@ -0,0 +1,204 @@
+import gzip
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.openmetrics import exposition as openmetrics
+
+from downloader_exporter.parallel import StaticRegistry
+from downloader_exporter.instrumentation import RENDER_DURATION, RENDER_SIZE
+
+DEFAULT_CACHE_MAX_AGE = 60
+# Distinct name[] selections are rare, a crawler sending random ones is not
+DEFAULT_CACHE_MAX_ENTRIES = 64
+GZIP_LEVEL = 6
+# Answer this many seconds before Prometheus gives up on the scrape
+SCRAPE_TIMEOUT_MARGIN = 0.5
+
+CacheEntry = namedtuple('CacheEntry', ['generation', 'created', 'exposition'])
+
+
+def choose_encoder(accept_header):
+    accept_header = accept_header or ''
+    for accepted in accept_header.split(','):
+        if accepted.split(';')[0].strip() == 'application/openmetrics-text':
+            return (openmetrics.generate_latest,
+                    openmetrics.CONTENT_TYPE_LATEST)
+    return generate_latest, CONTENT_TYPE_LATEST
+
+
+def accepts_gzip(accept_encoding):
+    """Whether gzip is acceptable, by its own q-value or else the one of ``*``."""
+    qvalues = {}
+    for coding in (accept_encoding or '').split(','):
+        name, *params = coding.split(';')
+        qvalue = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[name.strip().lower()] = qvalue
+    return qvalues.get('gzip', qvalues.get('x-gzip', qvalues.get('*', 0.0))) > 0
+
+
+def scrape_deadline(scrape_timeout, registry=None):
+    """Monotonic deadline from the X-Prometheus-Scrape-Timeout-Seconds header.
+
+    Without the header, the registry's ``scrape_timeout`` is used if it has one.
+    """
+    try:
+        seconds = max(0, float(scrape_timeout) - SCRAPE_TIMEOUT_MARGIN)
+    except (TypeError, ValueError):
+        seconds = getattr(registry, 'scrape_timeout', None)
+        if seconds is None:
+            return None
+    return time.monotonic() + seconds
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+
+class Exposition:
+    """A rendered registry, with its gzip variant compressed on first use.
+
+    Both variants get their own strong ETag, as they're different representations.
+    """
+
+    def __init__(self, output: bytes, content_type: str):
+        self.output = output
+        self.content_type = content_type
+        digest = hashlib.blake2b(output, digest_size=16).hexdigest()
+        self.etag = f'"{digest}"'
+        self.gzip_etag = f'"{digest}-gzip"'
+        self._gzipped = None
+
+    @property
+    def gzipped(self):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.output, compresslevel=GZIP_LEVEL)
+        return self._gzipped
+
+
+def render(registry, encoder, content_type, names=None):
+    if names is not None and hasattr(registry, 'restricted_registry'):
+        registry = registry.restricted_registry(names)
+    output_format = 'openmetrics' if encoder is openmetrics.generate_latest else 'text'
+    started = time.perf_counter()
+    output = encoder(registry)
+    RENDER_DURATION.labels(output_format).observe(time.perf_counter() - started)
+    RENDER_SIZE.labels(output_format).observe(len(output))
+    return Exposition(output, content_type)
+
+
+class ExpositionCache:
+    """Keeps the rendered output of registries whose data only changes on refresh.
+
+    A registry opts in by implementing ``cache_generation(names)``, returning a value
+    which changes whenever its data does, or None when it can't tell. Entries are
+    also dropped after ``max_age`` seconds so process metrics don't go stale forever.
+
+    Each ``name[]`` selection is its own entry, only the ``max_entries`` most recently
+    rendered are kept so arbitrary query strings can't grow the cache.
+    """
+
+    def __init__(self, max_age: float = DEFAULT_CACHE_MAX_AGE, max_entries: int = DEFAULT_CACHE_MAX_ENTRIES):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._locks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fresh(self, key, generation):
+        entry = self._entries.get(key)
+        if entry is not None and entry.generation == generation and time.monotonic() - entry.created < self.max_age:
+            return entry.exposition
+        return None
+
+    def get(self, registry, accept_header, names=None, deadline=None):
+        encoder, content_type = choose_encoder(accept_header)
+        cache_generation = getattr(registry, 'cache_generation', None)
+        generation = cache_generation(names) if cache_generation else None
+        view = registry.with_deadline(deadline) if hasattr(registry, 'with_deadline') else registry
+        if generation is None:
+            return render(view, encoder, content_type, names)
+
+        key = (id(registry), content_type, tuple(sorted(names)) if names is not None else None)
+        exposition = self._fresh(key, generation)
+        if exposition is not None:
+            return exposition
+
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+            self._locks.move_to_end(key)
+            if len(self._locks) > self.max_entries:
+                self._locks.popitem(last=False)
+        # Only one request renders a new generation, the others wait for it
+        with lock:
+            exposition = self._fresh(key, generation)
+            if exposition is None:
+                exposition = render(view, encoder, content_type, names)
+                # Compress right away, cached entries are usually served many times
+                exposition.gzipped
+                with self._lock:
+                    self._entries[key] = CacheEntry(generation, time.monotonic(), exposition)
+                    self._entries.move_to_end(key)
+                    if len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+        return exposition
+
+
+EXPOSITION_CACHE = ExpositionCache()
+
+
+def bake_output(registry, accept_header, accept_encoding, if_none_match, params, deadline=None, cache=EXPOSITION_CACHE):
+    """Bake output for metrics output."""
+    # The README documents name[], keep accepting the plain name too
+    names = params.get('name[]') or params.get('name')
+    exposition = cache.get(registry, accept_header, names, deadline)
+    return respond(exposition, accept_encoding, if_none_match)
+
+
+def bake_probe(registry, accept_header, accept_encoding, if_none_match, params, deadline=None):
+    """Bake output for /probe?target=a&target=b."""
+    targets = params.get('target')
+    if not targets:
+        return '400 Bad Request', [('Content-Type', 'text/plain')], b'Missing target parameter'
+    try:
+        metrics = registry.probe(targets, deadline)
+    except KeyError as e:
+        return '404 Not Found', [('Content-Type', 'text/plain')], f'Unknown target: {e.args[0]}'.encode()
+    encoder, content_type = choose_encoder(accept_header)
+    return respond(render(StaticRegistry(metrics), encoder, content_type), accept_encoding, if_none_match)
+
+
+def bake_targets(registry, host):
+    """Prometheus HTTP service discovery of the /probe targets, reached at ``host``."""
+    if not host:
+        return '400 Bad Request', [('Content-Type', 'text/plain')], b'Missing Host header'
+    targets = [
+        {"targets": [host], "labels": {"__metrics_path__": "/probe", "__param_target": name}}
+        for name in registry.target_names()
+    ]
+    return '200 OK', [('Content-Type', 'application/json')], json.dumps(targets).encode()
+
+
+def respond(exposition, accept_encoding, if_none_match):
+    gzipped = accepts_gzip(accept_encoding)
+    etag = exposition.gzip_etag if gzipped else exposition.etag
+    headers = [('Content-Type', exposition.content_type), ('ETag', etag), ('Vary', 'Accept-Encoding')]
+    if etag_matches(if_none_match, etag):
+        return '304 Not Modified', headers, b''
+    if gzipped:
+        headers.append(('Content-Encoding', 'gzip'))
+        return '200 OK', headers, exposition.gzipped
+    return '200 OK', headers, exposition.output
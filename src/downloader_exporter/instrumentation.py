@@ -0,0 +1,105 @@
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import CollectorRegistry, Metric
+
+# The exporter's own metrics, kept apart from the downloader registries
+REGISTRY = CollectorRegistry(auto_describe=True)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+
+COLLECT_DURATION = Histogram(
+    "downloader_exporter_collect_duration_seconds",
+    "Time spent collecting a downloader",
+    ["name"],
+    buckets=DURATION_BUCKETS,
+    registry=REGISTRY,
+)
+API_CALL_DURATION = Histogram(
+    "downloader_exporter_api_call_duration_seconds",
+    "Time spent in a downloader API call, retries included",
+    ["name", "call"],
+    buckets=DURATION_BUCKETS,
+    registry=REGISTRY,
+)
+API_RESPONSE_SIZE = Histogram(
+    "downloader_exporter_api_response_size_bytes",
+    "Size of the responses to a downloader API call",
+    ["name", "call"],
+    buckets=SIZE_BUCKETS,
+    registry=REGISTRY,
+)
+ERRORS = Counter(
+    "downloader_exporter_errors",
+    "Failed downloader API calls and collections",
+    ["name", "call"],
+    registry=REGISTRY,
+)
+TORRENTS_PROCESSED = Counter(
+    "downloader_exporter_torrents_processed",
+    "Torrents read from a downloader",
+    ["name"],
+    registry=REGISTRY,
+)
+RENDER_DURATION = Histogram(
+    "downloader_exporter_render_duration_seconds",
+    "Time spent rendering the exposition",
+    ["format"],
+    buckets=DURATION_BUCKETS,
+    registry=REGISTRY,
+)
+RENDER_SIZE = Histogram(
+    "downloader_exporter_render_size_bytes",
+    "Size of the rendered exposition, before compression",
+    ["format"],
+    buckets=SIZE_BUCKETS,
+    registry=REGISTRY,
+)
+
+
+class CallMeasurement:
+    """Filled in by the session while a call runs, ``size`` stays None when unknown."""
+
+    __slots__ = ('size',)
+
+    def __init__(self):
+        self.size = None
+
+
+@contextmanager
+def api_call(name: str, call: str):
+    """Times one downloader API call and counts it as an error if it raises."""
+    measurement = CallMeasurement()
+    started = time.perf_counter()
+    try:
+        yield measurement
+    except Exception:
+        ERRORS.labels(name, call).inc()
+        raise
+    finally:
+        API_CALL_DURATION.labels(name, call).observe(time.perf_counter() - started)
+        if measurement.size is not None:
+            API_RESPONSE_SIZE.labels(name, call).observe(measurement.size)
+
+
+class InstrumentationCollector:
+    """Exposes the exporter's own metrics.
+
+    With ``names``, only the series of these downloaders are kept, which is how each
+    ``--multi`` port gets its own. Series without a ``name`` label, like the render
+    metrics, are process wide and always kept.
+    """
+
+    def __init__(self, names=None):
+        self.names = set(names) if names is not None else None
+
+    def collect(self):
+        for metric in REGISTRY.collect():
+            if self.names is None:
+                yield metric
+                continue
+            filtered = Metric(metric.name, metric.documentation, metric.type, metric.unit)
+            filtered.samples = [s for s in metric.samples if "name" not in s.labels or s.labels["name"] in self.names]
+            yield filtered
@@ -0,0 +1,114 @@
+from itertools import chain
+from collections import namedtuple
+
+from prometheus_client.core import Metric, GaugeMetricFamily, CounterMetricFamily
+from prometheus_client.samples import Sample
+
+# Every metric the exporter emits, with its type and help text
+METRICS = {
+    "downloader_up": ("gauge", "Whether if server is alive or not"),
+    "downloader_download_bytes_total": ("counter", "Data downloaded this session (bytes)"),
+    "downloader_download_speed_bytes": ("gauge", "Data download speed (bytes)"),
+    "downloader_upload_bytes_total": ("counter", "Data uploaded this session (bytes)"),
+    "downloader_upload_speed_bytes": ("gauge", "Data upload speed (bytes)"),
+    "downloader_torrents_count": ("gauge", "Number of torrents by status, category and tracker"),
+    "downloader_tracker_torrent_upload_bytes_total": ("counter", "Data uploaded to tracker per torrent (bytes)"),
+    "downloader_tracker_torrent_download_bytes_total": ("counter", "Data downloaded from tracker per torrent (bytes)"),
+    "downloader_tracker_upload_bytes_total": ("counter", "Data uploaded to tracker by all torrents (bytes)"),
+    "downloader_tracker_download_bytes_total": ("counter", "Data downloaded from tracker by all torrents (bytes)"),
+    "downloader_tracker_category_upload_bytes_total": ("counter", "Data uploaded to tracker by torrents of a category, removed torrents included (bytes)"),
+    "downloader_tracker_category_download_bytes_total": ("counter", "Data downloaded from tracker by torrents of a category, removed torrents included (bytes)"),
+    "downloader_tracker_category_upload_speed_bytes": ("gauge", "Upload speed to tracker by torrents of a category, over the last collections (bytes)"),
+    "downloader_tracker_category_download_speed_bytes": ("gauge", "Download speed from tracker by torrents of a category, over the last collections (bytes)"),
+    "downloader_last_refresh_timestamp_seconds": ("gauge", "Unix time of the last completed background refresh"),
+    "downloader_scrape_timed_out": ("gauge", "Whether the downloader didn't answer before the scrape deadline"),
+    "downloader_circuit_open": ("gauge", "Whether the exporter stopped contacting the downloader after repeated failures"),
+    "downloader_data_age_seconds": ("gauge", "Age of the last known data served for a downloader which didn't answer in time"),
+}
+
+# Many samples of one metric, as ``(label_values, value)`` rows
+SampleRows = namedtuple('SampleRows', ['name', 'label_names', 'rows'])
+
+
+class MetricFamilies:
+    """Builds one metric family per metric name for a single collection.
+
+    The constant labels (``name``, ``version``, ...) are resolved once and appended
+    to the labels of every sample.
+    """
+
+    def __init__(self, const_labels: dict):
+        self.const_names = tuple(const_labels)
+        self.const_values = tuple(str(v) for v in const_labels.values())
+        self._families = {}
+
+    def family(self, name: str, label_names=()):
+        family = self._families.get(name)
+        if family is None:
+            metric_type, help_text = METRICS[name]
+            label_names = (*label_names, *self.const_names)
+            if metric_type == "counter":
+                family = CounterMetricFamily(name, help_text, labels=label_names)
+                family.sample_name = name
+            else:
+                family = GaugeMetricFamily(name, help_text, labels=label_names)
+                family.sample_name = family.name
+            family.label_names = label_names
+            self._families[name] = family
+        return family
+
+    def add(self, name: str, value, labels: dict = None):
+        labels = labels or {}
+        family = self.family(name, labels.keys())
+        family.samples.append(
+            Sample(
+                family.sample_name,
+                dict(zip(family.label_names, (*labels.values(), *self.const_values))),
+                value,
+            )
+        )
+
+    def extend(self, name: str, label_names, rows):
+        """Append ``(label_values, value)`` rows to the family in bulk."""
+        family = self.family(name, label_names)
+        sample_name = family.sample_name
+        names = family.label_names
+        const_values = self.const_values
+        family.samples.extend(
+            Sample(sample_name, dict(zip(names, (*values, *const_values))), value)
+            for values, value in rows
+        )
+
+    def __iter__(self):
+        return iter(self._families.values())
+
+
+def build_families(metrics, const_labels: dict):
+    families = MetricFamilies(const_labels)
+    for metric in metrics:
+        if isinstance(metric, SampleRows):
+            families.extend(*metric)
+        else:
+            families.add(metric["name"], metric["value"], metric.get("labels"))
+    return families
+
+
+def merge_families(metrics):
+    """Merge the families sharing a name, e.g. ``downloader_up`` of every downloader."""
+    families = {}
+    samples = {}
+    for metric in metrics:
+        if metric.name in families:
+            samples[metric.name].append(metric.samples)
+        else:
+            families[metric.name] = metric
+            samples[metric.name] = [metric.samples]
+
+    for name, metric in families.items():
+        if len(samples[name]) == 1:
+            yield metric
+            continue
+        # Families may belong to a cached snapshot, never modify them in place
+        merged = Metric(metric.name, metric.documentation, metric.type, metric.unit)
+        merged.samples = list(chain.from_iterable(samples[name]))
+        yield merged
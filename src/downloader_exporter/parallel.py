@@ -0,0 +1,314 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from loguru import logger
+from prometheus_client.core import CollectorRegistry
+
+from downloader_exporter.metrics import MetricFamilies, merge_families
+from downloader_exporter.instrumentation import ERRORS
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_COLLECT_TIMEOUT = 10
+DEFAULT_PROBE_MAX_AGE = 10
+DEFAULT_STALE_MAX_AGE = 300
+
+
+def is_downloader(collector):
+    return hasattr(collector, "client_name")
+
+
+def down_metrics(collector):
+    families = MetricFamilies(
+        {"name": collector.name, "version": "", "client": collector.client_name, "host": collector.host}
+    )
+    families.add("downloader_up", False)
+    return families
+
+
+def timeout_metrics(collector, timed_out: bool):
+    families = MetricFamilies({"name": collector.name, "client": collector.client_name, "host": collector.host})
+    families.add("downloader_scrape_timed_out", timed_out)
+    return families
+
+
+def data_age_metrics(collector, age: float):
+    families = MetricFamilies({"name": collector.name, "client": collector.client_name, "host": collector.host})
+    families.add("downloader_data_age_seconds", age)
+    return families
+
+
+def collect_timed(collector):
+    return list(collector.collect()), time.monotonic()
+
+
+class StaticRegistry:
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def collect(self):
+        return self.metrics
+
+
+class ScrapeView:
+    """What the encoders see of a ParallelRegistry for one scrape with a deadline."""
+
+    def __init__(self, registry, deadline: float):
+        self.registry = registry
+        self.deadline = deadline
+
+    def collect(self):
+        return self.registry.collect(self.deadline)
+
+    def restricted_registry(self, names):
+        return self.registry.restricted_registry(names, self.deadline)
+
+
+class ParallelRegistry(CollectorRegistry):
+    """Registry collecting every downloader concurrently on a bounded thread pool.
+
+    A downloader which doesn't answer within ``timeout`` seconds is reported as
+    ``downloader_up 0``. Its collection keeps running, and the next scrape waits on
+    the same call instead of piling up another one on a hung host. A result nobody
+    consumed yet is handed to the next scrape if it's less than ``timeout`` old.
+
+    Downloaders are also reachable by their config name as probe targets. The last
+    result of each one is kept, and probes reuse it while it's at most ``max_age``
+    seconds old.
+
+    Scrapes can come with a deadline, usually Prometheus's scrape timeout. A
+    downloader which misses it is served from its last result instead, if that is
+    at most ``stale_max_age`` seconds old, with ``downloader_data_age_seconds``.
+    ``scrape_timeout`` is the deadline used when the scrape doesn't set one.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = DEFAULT_CONCURRENCY,
+        timeout: float = DEFAULT_COLLECT_TIMEOUT,
+        max_age: float = DEFAULT_PROBE_MAX_AGE,
+        stale_max_age: float = DEFAULT_STALE_MAX_AGE,
+        scrape_timeout: float = None,
+    ):
+        super().__init__(auto_describe=False)
+        self.timeout = timeout
+        self.max_age = max_age
+        self.stale_max_age = stale_max_age
+        self.scrape_timeout = scrape_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="collect")
+        self._inflight = {}
+        self._results = {}
+        self._targets = {}
+        # Reentrant, done callbacks run right away in the submitting thread if the future already finished
+        self._inflight_lock = threading.RLock()
+
+    def register(self, collector):
+        super().register(collector)
+        if is_downloader(collector):
+            with self._inflight_lock:
+                self._targets[collector.name] = collector
+
+    def unregister(self, collector):
+        super().unregister(collector)
+        with self._inflight_lock:
+            self._inflight.pop(collector, None)
+            self._results.pop(collector, None)
+            if self._targets.get(getattr(collector, "name", None)) is collector:
+                del self._targets[collector.name]
+
+    def close(self):
+        """Stop the worker threads, collections already running finish in the background."""
+        self._executor.shutdown(wait=False)
+
+    def target_names(self):
+        with self._inflight_lock:
+            return list(self._targets)
+
+    def targets(self, names):
+        """The downloaders configured under ``names``, KeyError on unknown ones."""
+        with self._inflight_lock:
+            unknown = [name for name in names if name not in self._targets]
+            if unknown:
+                raise KeyError(", ".join(unknown))
+            return list(dict.fromkeys(self._targets[name] for name in names))
+
+    def last_result(self, collector):
+        """The last metrics of ``collector`` and when they were collected (unix time), or None."""
+        result = self._results.get(collector)
+        if result is None:
+            return None
+        metrics, completed = result
+        return metrics, time.time() - (time.monotonic() - completed)
+
+    def restore(self, collector, metrics, collected: float):
+        """Seed the last result of ``collector``, collected at unix time ``collected``.
+
+        Served like any other last result: to probes while fresh enough, and when the
+        downloader misses a scrape deadline, until a live collection replaces it.
+        """
+        with self._inflight_lock:
+            self._results.setdefault(collector, (metrics, time.monotonic() - max(0, time.time() - collected)))
+
+    def with_deadline(self, deadline: float = None):
+        return self if deadline is None else ScrapeView(self, deadline)
+
+    def _stale(self, collector):
+        """The last result and its age, None if there's none or it's too old to serve."""
+        result = self._results.get(collector)
+        if result is None or not self.stale_max_age:
+            return None
+        age = time.monotonic() - result[1]
+        return (result[0], age) if age <= self.stale_max_age else None
+
+    def _fresh(self, collector, max_age):
+        result = self._results.get(collector)
+        if max_age and result is not None and time.monotonic() - result[1] <= max_age:
+            return result[0]
+        return None
+
+    def _expired(self, future):
+        if not future.done():
+            return False
+        if future.exception() is not None:
+            return True
+        _, completed = future.result()
+        return time.monotonic() - completed > self.timeout
+
+    def _submit(self, collector):
+        with self._inflight_lock:
+            future = self._inflight.get(collector)
+            if future is None or self._expired(future):
+                future = self._executor.submit(collect_timed, collector)
+                future.submitted = time.monotonic()
+                future.add_done_callback(lambda f: self._record(collector, f))
+                self._inflight[collector] = future
+            return future
+
+    def _record(self, collector, future):
+        """Keep the result as soon as it's there, even if no scrape is waiting for it anymore."""
+        if future.exception() is not None:
+            return
+        with self._inflight_lock:
+            # Don't bring back a downloader which was unregistered in the meantime
+            if collector in self._collector_to_names:
+                self._store(collector, future.result())
+
+    def _store(self, collector, result):
+        # Both the done callback and the consuming scrape store it, keep the newest
+        current = self._results.get(collector)
+        if current is None or current[1] <= result[1]:
+            self._results[collector] = result
+
+    def _consume(self, collector, future):
+        with self._inflight_lock:
+            if self._inflight.get(collector) is future:
+                del self._inflight[collector]
+            if future.exception() is None:
+                self._store(collector, future.result())
+
+    def submit(self, collectors, max_age: float = 0):
+        """Start collecting the downloaders among ``collectors`` without waiting for them.
+
+        Downloaders with a result at most ``max_age`` seconds old are skipped.
+        """
+        return {
+            c: self._submit(c)
+            for c in collectors
+            if is_downloader(c) and self._fresh(c, max_age) is None
+        }
+
+    def remaining(self, futures, deadline: float = None):
+        """Seconds left to wait for ``futures``, at most until the ``deadline`` (monotonic)."""
+        if not futures:
+            return 0
+        # Measured from submission, so callers which already waited on them don't wait twice
+        end = max(f.submitted for f in futures) + self.timeout
+        if deadline is not None:
+            end = min(end, deadline)
+        return max(0, end - time.monotonic())
+
+    def resolve(self, names=None):
+        with self._lock:
+            if names is None:
+                return list(self._collector_to_names)
+            collectors = []
+            for name in names:
+                collector = self._names_to_collectors.get(name)
+                if collector is not None and collector not in collectors:
+                    collectors.append(collector)
+            return collectors
+
+    def cache_generation(self, names=None):
+        """Changes whenever a downloader has new data, None if any of them is collected live."""
+        generation = []
+        for collector in self.resolve(names):
+            if not is_downloader(collector):
+                continue
+            if getattr(collector, "generation", None) is None:
+                return None
+            future = self._inflight.get(collector)
+            if future is not None and not future.done():
+                # Might be served stale or reported down, don't keep that around
+                return None
+            generation.append((id(collector), collector.generation))
+        return tuple(generation)
+
+    def collect_from(self, collectors, deadline: float = None, max_age: float = 0):
+        return merge_families(self._collect_from(collectors, deadline, max_age))
+
+    def probe(self, names, deadline: float = None):
+        """Collect the targets ``names`` for /probe, see ``targets()`` and ``max_age``."""
+        return list(self.collect_from(self.targets(names), deadline, self.max_age))
+
+    def _collect_from(self, collectors, deadline=None, max_age=0):
+        futures = self.submit(collectors, max_age)
+        if futures:
+            wait(futures.values(), timeout=self.remaining(futures.values(), deadline))
+
+        for collector in collectors:
+            if not is_downloader(collector):
+                yield from collector.collect()
+                continue
+            future = futures.get(collector)
+            yield from timeout_metrics(collector, future is not None and not future.done())
+            if future is None:
+                # Skipped by submit(), its last result was fresh enough
+                yield from self._results.get(collector, ((), 0))[0]
+            elif not future.done():
+                ERRORS.labels(collector.name, "collect").inc()
+                stale = self._stale(collector)
+                if stale is None:
+                    logger.warning(f"[{collector.name}] Collection didn't finish in time")
+                    yield from down_metrics(collector)
+                else:
+                    # The collection keeps running, its result is there for the next scrape
+                    metrics, age = stale
+                    logger.warning(f"[{collector.name}] Collection didn't finish in time, serving data from {age:.0f}s ago")
+                    yield from metrics
+                    yield from data_age_metrics(collector, age)
+            elif future.exception() is not None:
+                logger.error(f"[{collector.name}] Collection failed: {future.exception()}")
+                ERRORS.labels(collector.name, "collect").inc()
+                self._consume(collector, future)
+                yield from down_metrics(collector)
+            else:
+                self._consume(collector, future)
+                yield from future.result()[0]
+
+    def collect(self, deadline: float = None):
+        with self._lock:
+            collectors = list(self._collector_to_names)
+            target_info = self._target_info_metric() if self._target_info else None
+        if target_info:
+            yield target_info
+        yield from self.collect_from(collectors, deadline)
+
+    def restricted_registry(self, names, deadline: float = None):
+        names = set(names)
+        metrics = []
+        with self._lock:
+            if 'target_info' in names and self._target_info:
+                metrics.append(self._target_info_metric())
+                names.remove('target_info')
+        metrics.extend(self.collect_from(self.resolve(names), deadline))
+        return StaticRegistry(metrics)
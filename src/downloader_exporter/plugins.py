@@ -0,0 +1,46 @@
+import threading
+from importlib.metadata import EntryPoint, entry_points
+
+from loguru import logger
+
+# Packages add clients by declaring a DownloaderCollector subclass in this group
+ENTRY_POINT_GROUP = "downloader_exporter.clients"
+
+# Also reachable when running from a source checkout, without installed metadata
+BUILTIN_CLIENTS = {
+    "qbittorrent": "downloader_exporter.qbittorrent_exporter:QbittorrentMetricsCollector",
+    "transmission": "downloader_exporter.transmission_exporter:TransmissionMetricsCollector",
+    "deluge": "downloader_exporter.deluge_exporter:DelugeMetricsCollector",
+}
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+def client_entry_points():
+    """Every known client, by the name used as ``client`` in the config."""
+    clients = {name: EntryPoint(name, value, ENTRY_POINT_GROUP) for name, value in BUILTIN_CLIENTS.items()}
+    found = entry_points()
+    # Python 3.9 returns a dict of groups, later versions a selectable collection
+    found = found.select(group=ENTRY_POINT_GROUP) if hasattr(found, "select") else found.get(ENTRY_POINT_GROUP, ())
+    clients.update((entry_point.name, entry_point) for entry_point in found)
+    return clients
+
+
+def load_client(client: str):
+    """The collector class of ``client``, None if it's unknown or can't be imported.
+
+    A client's module, and with it its client library, is only imported the first
+    time a downloader of that client is configured.
+    """
+    with _lock:
+        if client not in _loaded:
+            entry_point = client_entry_points().get(client)
+            collector_class = None
+            if entry_point is not None:
+                try:
+                    collector_class = entry_point.load()
+                except ImportError as e:
+                    logger.error(f"Can't load the {client} client: {e}")
+            _loaded[client] = collector_class
+        return _loaded[client]
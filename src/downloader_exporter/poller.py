@@ -0,0 +1,81 @@
+import time
+import random
+import threading
+from collections import namedtuple
+
+from loguru import logger
+
+from downloader_exporter.metrics import MetricFamilies
+
+Snapshot = namedtuple('Snapshot', ['metrics', 'timestamp'])
+
+DEFAULT_REFRESH_INTERVAL = 15
+# Every poll interval is stretched or shrunk by up to this fraction
+REFRESH_JITTER = 0.1
+
+
+class BackgroundCollector:
+    """Polls a collector from a worker thread and serves the latest snapshot on scrape.
+
+    The first poll happens right away. After it, each downloader moves to a random
+    phase of its interval and every interval is jittered, so downloaders started
+    together, or sharing a host, don't keep polling at the same moment.
+    """
+
+    def __init__(self, collector, interval: float = DEFAULT_REFRESH_INTERVAL, jitter: float = REFRESH_JITTER):
+        self.collector = collector
+        self.name = collector.name
+        self.host = collector.host
+        self.client_name = collector.client_name
+        self.interval = interval
+        self.jitter = jitter
+        self.snapshot = Snapshot((), 0.0)
+        self.generation = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def describe(self):
+        return self.collector.describe()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=f"poller-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def refresh(self):
+        try:
+            metrics = tuple(self.collector.collect())
+        except Exception as e:
+            logger.error(f"[{self.name}] Background refresh failed: {e}")
+            return
+        self.snapshot = Snapshot(metrics, time.time())
+        self.generation += 1
+
+    def restore(self, metrics, timestamp: float):
+        """Serve ``metrics`` taken at unix time ``timestamp`` until the first refresh."""
+        if not self.snapshot.timestamp:
+            self.snapshot = Snapshot(tuple(metrics), timestamp)
+            self.generation += 1
+
+    def _run(self):
+        self.refresh()
+        next_poll = time.monotonic() + random.uniform(0, self.interval)
+        while not self._stop.wait(max(0, next_poll - time.monotonic())):
+            self.refresh()
+            next_poll += self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            # After a refresh slower than the interval, poll again right away instead of catching up
+            next_poll = max(next_poll, time.monotonic())
+
+    def collect(self):
+        snapshot = self.snapshot
+        if not snapshot.timestamp:
+            return
+        yield from snapshot.metrics
+
+        families = MetricFamilies({"name": self.name, "client": self.client_name, "host": self.host})
+        families.add("downloader_last_refresh_timestamp_seconds", snapshot.timestamp)
+        yield from families
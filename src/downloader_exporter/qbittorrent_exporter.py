@@ -1,16 +1,44 @@
-from urllib.parse import urlparse
-from collections import Counter
-
 from loguru import logger
-from attrdict import AttrDict
-from qbittorrentapi import Client, TorrentStates
-from qbittorrentapi.exceptions import APIConnectionError
-from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from qbittorrentapi import Client as QbittorrentClient
+from qbittorrentapi.exceptions import APIConnectionError, Forbidden403Error, Unauthorized401Error
+
+from downloader_exporter.sessions import ClientSession
+from downloader_exporter.collector import DownloaderCollector
+from downloader_exporter.trackers import UNKNOWN_TRACKER
+from downloader_exporter.torrents import TorrentTable
+from downloader_exporter.constants import TorrentStatus
+
+
+class QbittorrentSession(ClientSession):
+    # Both are subclasses of APIConnectionError, so they have to be checked first
+    relogin_errors = (Forbidden403Error, Unauthorized401Error)
+    reconnect_errors = (APIConnectionError, OSError)
+
+    def __init__(self, name: str, host: str, username: str, password: str, verify_ssl: bool = False, **kwargs):
+        super().__init__(name, host, username, password, **kwargs)
+        self.verify_ssl = verify_ssl
+
+    def connect(self):
+        # The underlying requests session keeps the connection alive between calls
+        return QbittorrentClient(
+            host=self.host,
+            username=self.username,
+            password=self.password,
+            VERIFY_WEBUI_CERTIFICATE=self.verify_ssl,
+            REQUESTS_ARGS={"hooks": {"response": self._response_hook}},
+        )
+
+    def _response_hook(self, response, *args, **kwargs):
+        self.received(len(response.content))
+
+    def login(self, client):
+        client.auth_log_in()
 
-from downloader_exporter.constants import TorrentStatus, TorrentStat
 
+class QbittorrentMetricsCollector(DownloaderCollector):
+    client_name = "qbittorrent"
+    states_client = "qBittorrent"
 
-class QbittorrentMetricsCollector:
     TORRENT_STATUSES = [
         "downloading",
         "uploading",
@@ -27,163 +55,133 @@ class QbittorrentMetricsCollector:
         username: str,
         password: str,
         verify_ssl: bool = False,
+        incremental: bool = False,
         **kwargs,
     ):
-        self.name = name
-        self.host = host
-        self.username = username
-        self.password = password
         self.verify_ssl = verify_ssl
-
-    def describe(self):
-        return [AttrDict({"name": self.name, "type": "info"})]
-
-    def collect(self):
-        self.client = Client(
-            host=self.host,
-            username=self.username,
-            password=self.password,
-            VERIFY_WEBUI_CERTIFICATE=self.verify_ssl,
+        self.incremental = incremental
+        self._version_generation = None
+        super().__init__(name, host, username, password, **kwargs)
+        self.reset_sync()
+
+    def create_session(self, circuit):
+        return QbittorrentSession(
+            self.name, self.host, self.username, self.password, verify_ssl=self.verify_ssl, circuit=circuit
         )
-        try:
-            self.version = self.client.app.version
-            metrics = self.get_metrics()
-        except Exception as e:
-            logger.error(f"[{self.name}] Couldn't get server info: {e}")
-            self.version = ""
-            metrics = [
-                {
-                    "name": "downloader_up",
-                    "value": False,
-                    "help": "Whether if server is alive or not",
-                }
-            ]
-
-        for metric in metrics:
-            name = metric["name"]
-            value = metric["value"]
-            help_text = metric.get("help", "")
-            labels = {
-                **metric.get("labels", {}),
-                **{
-                    "name": self.name,
-                    "version": self.version,
-                    "client": "qbittorrent",
-                    "host": self.host,
-                },
-            }
-            metric_type = metric.get("type", "gauge")
-
-            if metric_type == "counter":
-                prom_metric = CounterMetricFamily(name, help_text, labels=labels.keys())
-            else:
-                prom_metric = GaugeMetricFamily(name, help_text, labels=labels.keys())
-            prom_metric.add_metric(value=value, labels=labels.values())
-            yield prom_metric
+
+    def reset_version(self):
+        self.version = ""
+        self._version_generation = None
+
+    def get_version(self):
+        # The version can only change if qBittorrent was restarted, which means a new login
+        if self._version_generation != self.session.generation:
+            self.version = self.session.call("app.version", lambda client: client.app.version)
+            self._version_generation = self.session.generation
+        return self.version
+
+    def reset_sync(self):
+        self._rid = 0
+        self._sync_generation = None
+        self._torrents = {}
+        self._categories = {}
+        self._server_state = {}
+
+    def sync(self):
+        """Patch the local tables with the changes since the last sync/maindata call."""
+        rid = self._rid if self._sync_generation == self.session.generation else 0
+        data = self.session.call("sync.maindata", lambda client: client.sync_maindata(rid=rid))
+        self._sync_generation = self.session.generation
+
+        if data.get("full_update", False):
+            self._torrents = {}
+            self._categories = {}
+            self._server_state = {}
+        for torrent_hash, torrent in data.get("torrents", {}).items():
+            self._torrents.setdefault(torrent_hash, {}).update(torrent)
+        for torrent_hash in data.get("torrents_removed", []):
+            self._torrents.pop(torrent_hash, None)
+        for category_name, category in data.get("categories", {}).items():
+            self._categories.setdefault(category_name, {}).update(category)
+        for category_name in data.get("categories_removed", []):
+            self._categories.pop(category_name, None)
+        self._server_state.update(data.get("server_state", {}))
+        self._rid = data.get("rid", 0)
 
     def get_metrics(self):
+        self.version = self.get_version()
+        if self.incremental:
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"[{self.name}] Couldn't sync main data: {e}")
+                self.reset_sync()
+
         metrics = []
         metrics.extend(self.get_status_metrics())
-        metrics.extend(self.get_torrent_metrics())
+        metrics.extend(self.torrent_cache.get(self.get_torrent_metrics))
 
         return metrics
 
     def get_status_metrics(self):
         response = {}
-        version = ""
 
         # Fetch data from API
-        try:
-            response = self.client.transfer.info
-        except Exception as e:
-            logger.error(f"[{self.name}] Couldn't get server info: {e}")
+        if self.incremental:
+            response = self._server_state
+        else:
+            try:
+                response = self.session.call("transfer.info", lambda client: client.transfer.info)
+            except Exception as e:
+                logger.error(f"[{self.name}] Couldn't get server info: {e}")
 
         return [
             {
                 "name": "downloader_up",
                 "value": response.get("connection_status", "") == "connected",
-                "help": "Whether if server is alive or not",
             },
             {
                 "name": "downloader_download_bytes_total",
                 "value": response.get("dl_info_data", 0),
-                "help": "Data downloaded this session (bytes)",
-                "type": "counter",
             },
             {
                 "name": "downloader_download_speed_bytes",
                 "value": response.get("dl_info_speed", 0),
-                "help": "Data download speed (bytes)",
             },
             {
                 "name": "downloader_upload_bytes_total",
                 "value": response.get("up_info_data", 0),
-                "help": "Data uploaded this session (bytes)",
-                "type": "counter",
             },
             {
                 "name": "downloader_upload_speed_bytes",
                 "value": response.get("up_info_speed", 0),
-                "help": "Data upload speed (bytes)",
             },
         ]
 
     def get_torrent_metrics(self):
-        try:
-            categories = self.client.torrent_categories.categories
-            torrents = self.client.torrents.info()
-        except Exception as e:
-            logger.error(f"[{self.name}] Couldn't fetch torrents: {e}")
-            return []
-
-        metrics = []
-        counter = Counter()
-        for torrent in torrents:
-            tracker = urlparse(torrent.get("tracker", "https://unknown.tracker")).netloc
-            counter[
-                TorrentStat(
-                    TorrentStatus.parse_qb(torrent["state"]).value,
-                    torrent.get("category", "Uncategorized"),
-                    tracker,
-                )
-            ] += 1
-            torrent_name = torrent.get("name", "unknown")
-            metrics.append(
-                {
-                    "name": "downloader_tracker_torrent_upload_bytes_total",
-                    "type": "counter",
-                    "value": torrent.get("uploaded", 0.0),
-                    "labels": {
-                        "torrent_name": torrent_name,
-                        "tracker": tracker,
-                    },
-                    "help": f"Data uploaded to tracker {tracker} for torrent {torrent_name}",
-                }
-            )
-            metrics.append(
-                {
-                    "name": "downloader_tracker_torrent_download_bytes_total",
-                    "type": "counter",
-                    "value": torrent.get("downloaded", 0.0),
-                    "labels": {
-                        "torrent_name": torrent_name,
-                        "tracker": tracker,
-                    },
-                    "help": f"Data downloaded to tracker {tracker} for torrent {torrent_name}",
-                }
+        if self.incremental:
+            if self._sync_generation is None:
+                # The sync failed, the local tables were dropped and aren't the torrent list
+                return []
+            torrents = self._torrents.items()
+        else:
+            try:
+                torrents = self.session.call("torrents.info", lambda client: client.torrents.info())
+            except Exception as e:
+                logger.error(f"[{self.name}] Couldn't fetch torrents: {e}")
+                return []
+            torrents = ((torrent.get("hash"), torrent) for torrent in torrents)
+
+        table = TorrentTable()
+        for torrent_hash, torrent in torrents:
+            table.append(
+                torrent.get("name", "unknown"),
+                TorrentStatus.parse_qb(torrent["state"], self.states).value,
+                torrent.get("category", "Uncategorized"),
+                self.trackers.resolve(torrent.get("tracker", UNKNOWN_TRACKER)),
+                torrent.get("uploaded", 0),
+                torrent.get("downloaded", 0),
+                torrent.get("last_activity"),
+                torrent_hash,
             )
-
-        for t, count in counter.items():
-            metrics.append(
-                {
-                    "name": "downloader_torrents_count",
-                    "value": count,
-                    "labels": {
-                        "status": t.status,
-                        "category": t.category,
-                        "tracker": t.tracker,
-                    },
-                    "help": f"Number of torrents in status {t.status} under category {t.category} with tracker {t.tracker}",
-                }
-            )
-        return metrics
+        return self.table_metrics(table)
@@ -0,0 +1,94 @@
+import threading
+
+from loguru import logger
+
+from downloader_exporter.circuit import CircuitBreaker, CircuitOpenError
+from downloader_exporter.instrumentation import api_call
+
+
+class ClientSession:
+    """Keeps one authenticated client alive per downloader.
+
+    Errors in ``relogin_errors`` trigger a new login on the same client, errors in
+    ``reconnect_errors`` drop the client and build a new one. Either way the call is
+    retried once. ``generation`` is bumped every time a new client is connected or
+    logged in again, so callers can tell when server side state (cursors, cached
+    versions) was lost.
+
+    Every call is named, e.g. ``torrents.info``, for the exporter's own metrics.
+    Transports report the bytes they receive with ``received()``.
+
+    While the ``circuit`` is open, calls raise CircuitOpenError without touching the
+    network. The collector feeds it once per collection, not per call.
+    """
+
+    relogin_errors = ()
+    reconnect_errors = (OSError,)
+
+    def __init__(self, name: str, host: str, username: str, password: str, circuit: CircuitBreaker = None):
+        self.name = name
+        self.host = host
+        self.username = username
+        self.password = password
+        self.circuit = circuit or CircuitBreaker(name)
+        self.generation = 0
+        self.received_bytes = 0
+        self._client = None
+        self._lock = threading.RLock()
+
+    def connect(self):
+        raise NotImplementedError
+
+    def login(self, client):
+        self.reset()
+
+    def disconnect(self, client):
+        pass
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.connect()
+            self.generation += 1
+        return self._client
+
+    def reset(self):
+        with self._lock:
+            client, self._client = self._client, None
+            if client is None:
+                return
+            try:
+                self.disconnect(client)
+            except Exception as e:
+                logger.debug(f"[{self.name}] Error while closing connection: {e}")
+
+    def received(self, size: int):
+        self.received_bytes += size
+
+    def call(self, call: str, fn, *args, **kwargs):
+        with self._lock:
+            if not self.circuit.allow():
+                raise CircuitOpenError(f"Circuit open, next attempt in {self.circuit.remaining():.0f}s")
+            with api_call(self.name, call) as measurement:
+                received = self.received_bytes
+                result = self._call(fn, *args, **kwargs)
+                measurement.size = self.received_bytes - received
+                return result
+
+    def _call(self, fn, *args, **kwargs):
+        for attempt in range(2):
+            client = self.client
+            try:
+                return fn(client, *args, **kwargs)
+            except self.relogin_errors as e:
+                if attempt:
+                    raise
+                logger.info(f"[{self.name}] Session expired, logging in again: {e}")
+                self.login(client)
+                self.generation += 1
+            except self.reconnect_errors as e:
+                self.reset()
+                if attempt:
+                    raise
+                logger.info(f"[{self.name}] Connection lost, reconnecting: {e}")
+
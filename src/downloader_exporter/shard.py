@@ -0,0 +1,63 @@
+import hashlib
+
+from loguru import logger
+from prometheus_client.core import GaugeMetricFamily
+
+
+def score(name: str, shard: int):
+    # Stable across processes and machines, unlike hash()
+    return int.from_bytes(hashlib.sha256(f"{shard}:{name}".encode()).digest()[:8], "big")
+
+
+class Shard:
+    """One of ``count`` exporter replicas, collecting the downloaders it owns.
+
+    Ownership uses rendezvous hashing: every replica ranks all the shards for a
+    config name, and the best ranked one owns it. Every replica gets the same
+    answer from the same config, and when ``count`` changes only the downloaders
+    won by the added shard, or left by the removed one, move.
+    """
+
+    def __init__(self, index: int, count: int):
+        if not 0 <= index < count:
+            raise ValueError(f"Shard index must be between 0 and {count - 1}, got {index}")
+        self.index = index
+        self.count = count
+
+    def owner(self, name: str):
+        return max(range(self.count), key=lambda shard: score(name, shard))
+
+    def owns(self, name: str):
+        return self.count == 1 or self.owner(name) == self.index
+
+    def select(self, config: dict):
+        """The entries of ``config`` this shard collects."""
+        owned = {name: c for name, c in config.items() if self.owns(name)}
+        logger.info(f"Shard {self.index}/{self.count} owns {len(owned)} of {len(config)} downloaders")
+        return owned
+
+
+class ShardCollector:
+    """Tells which shard this exporter is, and which of the registry's downloaders it owns."""
+
+    def __init__(self, shard: Shard, registry):
+        self.shard = shard
+        self.registry = registry
+
+    def collect(self):
+        info = GaugeMetricFamily(
+            "downloader_exporter_shard",
+            "Shard of this exporter among its replicas",
+            labels=["index", "count"],
+        )
+        info.add_metric([str(self.shard.index), str(self.shard.count)], 1)
+        yield info
+
+        targets = GaugeMetricFamily(
+            "downloader_exporter_shard_target",
+            "Downloaders owned and collected by this exporter",
+            labels=["name"],
+        )
+        for name in self.registry.target_names():
+            targets.add_metric([name], 1)
+        yield targets
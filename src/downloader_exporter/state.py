@@ -0,0 +1,111 @@
+import sys
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+
+from loguru import logger
+from prometheus_client.core import Metric
+from prometheus_client.samples import Sample
+
+DEFAULT_STATE_INTERVAL = 60
+# Bump when the stored layout changes, older files are then ignored
+STATE_FORMAT = 2
+# Left out of the fingerprint, a hash of them on disk could be brute forced offline
+CREDENTIAL_KEYS = ('username', 'password')
+
+
+def fingerprint(config: dict):
+    """Identifies a downloader config entry, state saved for another config isn't restored."""
+    config = {key: value for key, value in config.items() if key not in CREDENTIAL_KEYS}
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def dump_metrics(metrics):
+    families = [
+        (m.name, m.documentation, m.type, m.unit, [(s.name, s.labels, s.value) for s in m.samples])
+        for m in metrics
+    ]
+    return zlib.compress(json.dumps(families, separators=(',', ':')).encode())
+
+
+def load_metrics(blob):
+    intern = sys.intern
+    metrics = []
+    for name, documentation, metric_type, unit, samples in json.loads(zlib.decompress(blob)):
+        metric = Metric(name, documentation, metric_type, unit)
+        # Label values repeat across samples (tracker, category, ...), share them like a live collection does
+        metric.samples = [
+            Sample(sample_name, {intern(k): intern(v) if type(v) is str else v for k, v in labels.items()}, value)
+            for sample_name, labels, value in samples
+        ]
+        metrics.append(metric)
+    return metrics
+
+
+class StateFile:
+    """Keeps the last metrics of every downloader in a SQLite file across restarts.
+
+    Each downloader is one row, keyed by its config name and stored with the
+    fingerprint of its config entry and the unix time the metrics were collected.
+    Rows of downloaders which are no longer configured are dropped on save, the
+    others are kept until the downloader has newer metrics.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS downloaders ("
+            "name TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, format INTEGER NOT NULL, "
+            "collected REAL NOT NULL, metrics BLOB NOT NULL)"
+        )
+        return db
+
+    def save(self, snapshots, names):
+        """Save ``{name: (fingerprint, collected, metrics)}``, keeping only the downloaders in ``names``."""
+        rows = [
+            (name, config_fingerprint, STATE_FORMAT, collected, dump_metrics(metrics))
+            for name, (config_fingerprint, collected, metrics) in snapshots.items()
+        ]
+        started = time.monotonic()
+        try:
+            db = self._connect()
+            try:
+                with db:
+                    saved = [row[0] for row in db.execute("SELECT name FROM downloaders")]
+                    names = set(names)
+                    db.executemany("DELETE FROM downloaders WHERE name = ?", [(name,) for name in saved if name not in names])
+                    db.executemany("INSERT OR REPLACE INTO downloaders VALUES (?, ?, ?, ?, ?)", rows)
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            logger.error(f"Can't save state file {self.path}: {e}")
+            return
+        logger.debug(f"Saved the state of {len(rows)} downloaders in {time.monotonic() - started:.3f}s")
+
+    def load(self):
+        """The saved ``{name: (fingerprint, collected, metrics)}``, empty if there's no usable file."""
+        snapshots = {}
+        try:
+            db = self._connect()
+            try:
+                rows = db.execute(
+                    "SELECT name, fingerprint, collected, metrics FROM downloaders WHERE format = ?",
+                    (STATE_FORMAT,),
+                ).fetchall()
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            logger.warning(f"Can't read state file {self.path}, starting cold: {e}")
+            return snapshots
+
+        for name, config_fingerprint, collected, blob in rows:
+            try:
+                snapshots[name] = (config_fingerprint, collected, load_metrics(blob))
+            except (zlib.error, ValueError, TypeError) as e:
+                logger.warning(f"[{name}] Ignoring broken saved state: {e}")
+        return snapshots
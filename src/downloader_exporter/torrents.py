@@ -0,0 +1,312 @@
+import sys
+import time
+import heapq
+from array import array
+from collections import Counter, defaultdict, deque
+
+from downloader_exporter.metrics import SampleRows
+
+
+class TorrentTable:
+    """Torrents of one collection, stored column by column.
+
+    Strings repeated across torrents (status, category, tracker) are interned so
+    every torrent shares the same objects, byte counters live in ``array('q')``
+    columns, and ``last_activity`` is a unix time, NaN when the client doesn't say.
+    ``keys`` identify a torrent across collections, usually its info hash.
+    """
+
+    __slots__ = ('keys', 'names', 'statuses', 'categories', 'trackers', 'uploaded', 'downloaded', 'last_activity')
+
+    def __init__(self):
+        self.keys = []
+        self.names = []
+        self.statuses = []
+        self.categories = []
+        self.trackers = []
+        self.uploaded = array('q')
+        self.downloaded = array('q')
+        self.last_activity = array('d')
+
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, name, status, category, tracker, uploaded, downloaded, last_activity=None, key=None):
+        intern = sys.intern
+        self.keys.append(name if key is None else key)
+        self.names.append(name)
+        self.statuses.append(intern(status))
+        self.categories.append(intern(category) if type(category) is str else category)
+        self.trackers.append(intern(tracker))
+        self.uploaded.append(int(uploaded or 0))
+        self.downloaded.append(int(downloaded or 0))
+        self.last_activity.append(float('nan') if last_activity is None else last_activity)
+
+
+TOP_TORRENTS_BY = ('uploaded', 'downloaded')
+DEFAULT_RATE_WINDOW = 5
+
+
+class TrackerTotals:
+    """Upload and download counters per tracker and category, across collections.
+
+    Summing the torrents' own counters would go down whenever a torrent is removed.
+    Instead the last counters of every torrent are kept by key, and the bytes of a
+    torrent which is removed, moves to another tracker or category, or whose counters
+    go down, are folded into an offset of its previous group. The totals only ever
+    grow, like per-torrent counters do.
+
+    The totals of the last ``window`` collections are kept to compute speeds from,
+    so graphs don't need ``rate()`` over the per-torrent series.
+
+    An empty table after a non-empty one is ignored, it's far more likely a failed
+    poll than every torrent removed at once. Skipping it changes nothing for real
+    removals: their bytes stay in the totals either way.
+    """
+
+    def __init__(self, window: int = DEFAULT_RATE_WINDOW):
+        self._last = {}
+        self._offsets = defaultdict(lambda: [0, 0])
+        self._history = deque(maxlen=window)
+        self._totals = {}
+        self._speeds = {}
+
+    def update(self, table: TorrentTable):
+        """Fold ``table`` into the totals.
+
+        Returns the totals and the speeds, both as ``{(tracker, category): (uploaded, downloaded)}``.
+        """
+        if not len(table) and self._last:
+            return self._totals, self._speeds
+
+        last, offsets = self._last, self._offsets
+        current = {}
+        totals = defaultdict(lambda: [0, 0])
+        for key, tracker, category, uploaded, downloaded in zip(
+            table.keys, table.trackers, table.categories, table.uploaded, table.downloaded
+        ):
+            group = (tracker, category)
+            previous = last.pop(key, None)
+            if previous is not None:
+                previous_group, previous_uploaded, previous_downloaded = previous
+                if previous_group != group:
+                    # The old group keeps what the torrent sent while in it, the new one only counts what comes next
+                    offset = offsets[previous_group]
+                    offset[0] += max(previous_uploaded, uploaded)
+                    offset[1] += max(previous_downloaded, downloaded)
+                    offset = offsets[group]
+                    offset[0] -= uploaded
+                    offset[1] -= downloaded
+                else:
+                    # Reset counters, e.g. a torrent removed and added back between two collections
+                    if uploaded < previous_uploaded:
+                        offsets[group][0] += previous_uploaded
+                    if downloaded < previous_downloaded:
+                        offsets[group][1] += previous_downloaded
+            current[key] = (group, uploaded, downloaded)
+            total = totals[group]
+            total[0] += uploaded
+            total[1] += downloaded
+
+        # Whatever is left was removed since the last collection
+        for group, uploaded, downloaded in last.values():
+            offset = offsets[group]
+            offset[0] += uploaded
+            offset[1] += downloaded
+        self._last = current
+
+        for group, (uploaded, downloaded) in offsets.items():
+            total = totals[group]
+            total[0] += uploaded
+            total[1] += downloaded
+
+        now = time.monotonic()
+        speeds = {}
+        for group, (uploaded, downloaded) in totals.items():
+            # Measured from the oldest collection which already had the group
+            for then, past in self._history:
+                if group in past and now > then:
+                    past_uploaded, past_downloaded = past[group]
+                    speeds[group] = ((uploaded - past_uploaded) / (now - then), (downloaded - past_downloaded) / (now - then))
+                    break
+        self._history.append((now, totals))
+        self._totals, self._speeds = totals, speeds
+        return totals, speeds
+
+    def metrics(self, table: TorrentTable):
+        totals, speeds = self.update(table)
+        label_names = ("tracker", "category")
+        return [
+            SampleRows(
+                "downloader_tracker_category_upload_bytes_total",
+                label_names,
+                [(group, uploaded) for group, (uploaded, _) in totals.items()],
+            ),
+            SampleRows(
+                "downloader_tracker_category_download_bytes_total",
+                label_names,
+                [(group, downloaded) for group, (_, downloaded) in totals.items()],
+            ),
+            SampleRows(
+                "downloader_tracker_category_upload_speed_bytes",
+                label_names,
+                [(group, uploaded) for group, (uploaded, _) in speeds.items()],
+            ),
+            SampleRows(
+                "downloader_tracker_category_download_speed_bytes",
+                label_names,
+                [(group, downloaded) for group, (_, downloaded) in speeds.items()],
+            ),
+        ]
+
+
+class TorrentMetricsCache:
+    """Keeps the torrent metrics between torrent list scans.
+
+    Listing every torrent is much more expensive than reading the transfer totals,
+    so with ``torrents_interval`` in the downloader config the list is only scanned
+    every that many seconds, and collections in between reuse the last metrics.
+    """
+
+    def __init__(self, interval: float = 0):
+        self.interval = interval
+        self.metrics = []
+        self._refreshed = None
+
+    def due(self):
+        return (
+            self._refreshed is None
+            or not self.interval
+            or time.monotonic() - self._refreshed >= self.interval
+        )
+
+    def store(self, metrics):
+        self.metrics = metrics
+        # A failed scan is retried on the next collection
+        self._refreshed = time.monotonic() if metrics else None
+        return metrics
+
+    def get(self, scan):
+        if self.due():
+            self.store(scan())
+        return self.metrics
+
+
+class TorrentSelection:
+    """Decides which torrents get their own per-torrent series.
+
+    Built from the downloader config:
+
+    - ``per_torrent``: set to false to only export per-tracker totals
+    - ``top_torrents``: only keep the K torrents with the most ``top_torrents_by``
+      (``uploaded`` or ``downloaded``)
+    - ``active_minutes``: only keep torrents with activity in the last N minutes
+    - ``categories``/``exclude_categories`` and ``trackers``/``exclude_trackers``:
+      allow and deny lists
+    """
+
+    def __init__(
+        self,
+        per_torrent: bool = True,
+        top_torrents: int = 0,
+        top_torrents_by: str = 'uploaded',
+        active_minutes: float = 0,
+        categories=None,
+        exclude_categories=None,
+        trackers=None,
+        exclude_trackers=None,
+    ):
+        if top_torrents_by not in TOP_TORRENTS_BY:
+            raise ValueError(f"top_torrents_by must be one of {', '.join(TOP_TORRENTS_BY)}, got {top_torrents_by}")
+        self.per_torrent = per_torrent
+        self.top_torrents = top_torrents
+        self.top_torrents_by = top_torrents_by
+        self.active_seconds = active_minutes * 60
+        self.categories = set(categories) if categories else None
+        self.exclude_categories = set(exclude_categories or ())
+        self.trackers = set(trackers) if trackers else None
+        self.exclude_trackers = set(exclude_trackers or ())
+
+    @classmethod
+    def from_config(cls, config: dict):
+        return cls(**{key: config[key] for key in (
+            'per_torrent', 'top_torrents', 'top_torrents_by', 'active_minutes',
+            'categories', 'exclude_categories', 'trackers', 'exclude_trackers',
+        ) if key in config})
+
+    @property
+    def filtered(self):
+        return bool(
+            self.active_seconds
+            or self.categories is not None
+            or self.exclude_categories
+            or self.trackers is not None
+            or self.exclude_trackers
+        )
+
+    def select(self, table: TorrentTable):
+        """Return the indexes of the torrents to export."""
+        selected = range(len(table))
+        if self.filtered:
+            categories, trackers = table.categories, table.trackers
+            if self.categories is not None:
+                selected = [i for i in selected if categories[i] in self.categories]
+            if self.exclude_categories:
+                selected = [i for i in selected if categories[i] not in self.exclude_categories]
+            if self.trackers is not None:
+                selected = [i for i in selected if trackers[i] in self.trackers]
+            if self.exclude_trackers:
+                selected = [i for i in selected if trackers[i] not in self.exclude_trackers]
+            if self.active_seconds:
+                active_since = time.time() - self.active_seconds
+                last_activity = table.last_activity
+                # NaN compares as false, torrents without a known activity time are kept
+                selected = [i for i in selected if not last_activity[i] < active_since]
+        if self.top_torrents:
+            # Keeps a heap of K entries instead of sorting every torrent
+            column = getattr(table, self.top_torrents_by)
+            selected = heapq.nlargest(self.top_torrents, selected, key=column.__getitem__)
+        return selected
+
+
+def torrent_metrics(table: TorrentTable, selection: TorrentSelection):
+    counter = Counter(zip(table.statuses, table.categories, table.trackers))
+    metrics = [
+        SampleRows(
+            "downloader_torrents_count",
+            ("status", "category", "tracker"),
+            list(counter.items()),
+        )
+    ]
+
+    if selection.per_torrent:
+        selected = selection.select(table)
+        names, trackers = table.names, table.trackers
+        uploaded, downloaded = table.uploaded, table.downloaded
+        metrics.append(SampleRows(
+            "downloader_tracker_torrent_upload_bytes_total",
+            ("torrent_name", "tracker"),
+            [((names[i], trackers[i]), uploaded[i]) for i in selected],
+        ))
+        metrics.append(SampleRows(
+            "downloader_tracker_torrent_download_bytes_total",
+            ("torrent_name", "tracker"),
+            [((names[i], trackers[i]), downloaded[i]) for i in selected],
+        ))
+    else:
+        uploaded = defaultdict(int)
+        downloaded = defaultdict(int)
+        for tracker, up, down in zip(table.trackers, table.uploaded, table.downloaded):
+            uploaded[tracker] += up
+            downloaded[tracker] += down
+        metrics.append(SampleRows(
+            "downloader_tracker_upload_bytes_total",
+            ("tracker",),
+            [((tracker,), value) for tracker, value in uploaded.items()],
+        ))
+        metrics.append(SampleRows(
+            "downloader_tracker_download_bytes_total",
+            ("tracker",),
+            [((tracker,), value) for tracker, value in downloaded.items()],
+        ))
+    return metrics
@@ -0,0 +1,44 @@
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+UNKNOWN_TRACKER = "https://unknown.tracker"
+DEFAULT_CACHE_SIZE = 4096
+
+
+class TrackerResolver:
+    """Turns announce URLs into the ``tracker`` label.
+
+    Torrents share a handful of announce URLs, so results are kept in a bounded LRU
+    cache. ``aliases`` maps a label to the hosts folded into it, ``*.example.org``
+    matching example.org and all its subdomains::
+
+        tracker_aliases:
+            example: ["tracker.example.org", "*.example.net"]
+
+    Hosts without an alias keep the announce URL's netloc as label.
+    """
+
+    def __init__(self, aliases: dict = None, cache_size: int = DEFAULT_CACHE_SIZE):
+        self.hosts = {}
+        self.suffixes = []
+        for label, hosts in (aliases or {}).items():
+            if isinstance(hosts, str):
+                hosts = [hosts]
+            for host in hosts:
+                host = host.lower()
+                if host.startswith("*."):
+                    self.suffixes.append((host[1:], label))
+                    host = host[2:]
+                self.hosts[host] = label
+        self.resolve = lru_cache(maxsize=cache_size)(self._resolve)
+
+    def _resolve(self, url: str) -> str:
+        try:
+            parsed = urlsplit(url)
+            host = parsed.hostname or ""
+        except ValueError:
+            return url
+        label = self.hosts.get(host)
+        if label is None:
+            label = next((alias for suffix, alias in self.suffixes if host.endswith(suffix)), None)
+        return parsed.netloc if label is None else label
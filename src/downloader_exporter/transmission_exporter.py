@@ -1,19 +1,76 @@
 import time
-from urllib.parse import urlparse
-from collections import Counter
 
 from loguru import logger
 from attrdict import AttrDict
-from transmission_rpc import Client
-from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from transmission_rpc import Client as TransmissionClient
+from transmission_rpc.error import TransmissionAuthError, TransmissionConnectError
 
 from downloader_exporter.utils import url_parse
-from downloader_exporter.constants import TorrentStatus, TorrentStat
+from downloader_exporter.sessions import ClientSession
+from downloader_exporter.collector import DownloaderCollector
+from downloader_exporter.trackers import UNKNOWN_TRACKER
+from downloader_exporter.torrents import TorrentTable
+from downloader_exporter.circuit import CircuitOpenError
+from downloader_exporter.constants import TorrentStatus
+
+TRANSMISSION_DEFAULT_PORT = 9091
+
+TORRENT_ARGUMENTS = [
+    "id",
+    "name",
+    "status",
+    "labels",
+    # Only the announce URL is needed, trackerStats is much larger
+    "trackers",
+    "isFinished",
+    "isStalled",
+    "uploadedEver",
+    "downloadedEver",
+    "activityDate",
+]
+# Transmission only reports torrents changed or removed within the last 60 seconds,
+# leave some slack for the request itself
+RECENTLY_ACTIVE_WINDOW = 50
+DEFAULT_FULL_SYNC_INTERVAL = 600
+
+
+class InstrumentedTransmissionClient(TransmissionClient):
+    def __init__(self, *args, session: ClientSession, **kwargs):
+        # Set before super().__init__, which already fetches the session
+        self._instrumentation_session = session
+        super().__init__(*args, **kwargs)
+
+    def _http_query(self, *args, **kwargs):
+        text = super()._http_query(*args, **kwargs)
+        self._instrumentation_session.received(len(text))
+        return text
+
+
+class TransmissionSession(ClientSession):
+    # The X-Transmission-Session-Id handshake is handled by transmission_rpc itself
+    reconnect_errors = (TransmissionConnectError, TransmissionAuthError, OSError)
+
+    def __init__(self, name: str, host: str, username: str, password: str, timeout: int = 60, **kwargs):
+        super().__init__(name, host, username, password, **kwargs)
+        self.timeout = timeout
+
+    def connect(self):
+        scheme, host, port = url_parse(self.host, TRANSMISSION_DEFAULT_PORT)
+        return InstrumentedTransmissionClient(
+            session=self,
+            host=host,
+            port=port,
+            username=self.username,
+            password=self.password,
+            protocol="https" if scheme == "https" or port == 443 else "http",
+            timeout=self.timeout,
+        )
 
-DEFAULT_PORT = 9091
 
+class TransmissionMetricsCollector(DownloaderCollector):
+    client_name = "transmission"
+    states_client = "Transmission"
 
-class TransmissionMetricsCollector:
     def __init__(
         self,
         name: str,
@@ -21,179 +78,149 @@ class TransmissionMetricsCollector:
         username: str,
         password: str,
         timeout: int = 60,
+        incremental: bool = False,
+        full_sync_interval: int = DEFAULT_FULL_SYNC_INTERVAL,
         **kwargs,
     ):
-        self.name = name
-        self.host = host
-        self.username = username
-        self.password = password
         self.timeout = timeout
-        self.version = None
-
-    @property
-    def client(self):
-        scheme, host, port = url_parse(self.host, DEFAULT_PORT)
-        return Client(
-            host=host,
-            port=port,
-            username=self.username,
-            password=self.password,
-            protocol="https" if scheme == "https" or port == 443 else "http",
-            timeout=self.timeout,
-        )
-
-    def describe(self):
-        return [AttrDict({"name": self.name, "type": "info"})]
-
-    def collect(self):
-        metrics = self.get_metrics()
-
-        for metric in metrics:
-            name = metric["name"]
-            value = metric["value"]
-            help_text = metric.get("help", "")
-            labels = {
-                **metric.get("labels", {}),
-                **{
-                    "name": self.name,
-                    "version": self.version,
-                    "client": "transmission",
-                    "host": self.host,
-                },
-            }
-            metric_type = metric.get("type", "gauge")
-
-            if metric_type == "counter":
-                prom_metric = CounterMetricFamily(name, help_text, labels=labels.keys())
-            else:
-                prom_metric = GaugeMetricFamily(name, help_text, labels=labels.keys())
-            prom_metric.add_metric(value=value, labels=labels.values())
-            yield prom_metric
+        self.incremental = incremental
+        self.full_sync_interval = full_sync_interval
+        super().__init__(name, host, username, password, **kwargs)
+        self.torrent_arguments = list(TORRENT_ARGUMENTS)
+        if self.tracker_totals is not None:
+            # Ids are reassigned when Transmission restarts, totals need to follow torrents across restarts
+            self.torrent_arguments.append("hashString")
+        self._torrents = {}
+        self._sync_generation = None
+        self._last_sync = 0
+        self._last_full_sync = 0
+        self._daemon_session = None
+
+    def create_session(self, circuit):
+        return TransmissionSession(self.name, self.host, self.username, self.password, timeout=self.timeout, circuit=circuit)
 
     def get_metrics(self):
         metrics = []
         metrics.extend(self.get_status_metrics())
-        metrics.extend(self.get_torrent_metrics())
+        if self.incremental:
+            # Changes drop out of Transmission's window after a minute, so they're applied on
+            # every poll even when the torrent metrics are only rebuilt at torrents_interval
+            torrents = self.fetch_torrents()
+            metrics.extend(self.torrent_cache.get(lambda: self.get_torrent_metrics(torrents)))
+        else:
+            metrics.extend(self.torrent_cache.get(lambda: self.get_torrent_metrics(self.fetch_torrents())))
         return metrics
 
     def get_status_metrics(self):
         try:
-            session = self.client.get_session()
-            session_stats = self.client.session_stats()
+            session = self.session.call("session-get", lambda client: client.get_session())
+            session_stats = self.session.call("session-stats", lambda client: client.session_stats())
             self.version = session.version
             stat = session_stats.cumulative_stats
+            self.check_restart(stat, session_stats.current_stats)
         except Exception as e:
-            logger.error(f"[{self.name}] Can not get client session: {e}")
+            if not isinstance(e, CircuitOpenError):
+                logger.error(f"[{self.name}] Can not get client session: {e}")
             self.version = ""
-            session = AttrDict()
+            session_stats = AttrDict()
             stat = {}
 
         return [
             {
                 "name": "downloader_up",
                 "value": self.version != "",
-                "help": "Whether if server is alive or not",
             },
             {
                 "name": "downloader_download_bytes_total",
                 "value": stat.get("downloadedBytes", 0),
-                "help": "Data downloaded this session (bytes)",
-                "type": "counter",
             },
             {
                 "name": "downloader_download_speed_bytes",
-                "value": getattr(session, "downloadSpeed", 0),
-                "help": "Data download speed (bytes)",
+                "value": session_stats.get("downloadSpeed", 0),
             },
             {
                 "name": "downloader_upload_bytes_total",
                 "value": stat.get("uploadedBytes", 0),
-                "help": "Data uploaded this session (bytes)",
-                "type": "counter",
             },
             {
                 "name": "downloader_upload_speed_bytes",
-                "value": getattr(session, "uploadSpeed", 0),
-                "help": "Data upload speed (bytes)",
+                "value": session_stats.get("uploadSpeed", 0),
             },
         ]
 
-    def get_torrent_metrics(self):
-        try:
-            torrents = self.client.get_torrents(
-                arguments=[
-                    "name",
-                    "status",
-                    "labels",
-                    "trackerStats",
-                    "isFinished",
-                    "isStalled",
-                    "uploadedEver",
-                    "downloadedEver",
-                ]
+    def check_restart(self, cumulative_stats, current_stats):
+        """Force a full fetch when Transmission restarted.
+
+        transmission_rpc renews the session id and requests replaces the dead
+        connection without raising, so the session generation doesn't change. But
+        torrent ids are reassigned on restart, and patching the old table by id would
+        mix up torrents.
+        """
+        daemon_session = (cumulative_stats.get("sessionCount"), current_stats.get("secondsActive", 0))
+        previous, self._daemon_session = self._daemon_session, daemon_session
+        if previous is not None and (daemon_session[0] != previous[0] or daemon_session[1] < previous[1]):
+            logger.info(f"[{self.name}] Transmission restarted, fetching every torrent again")
+            self._sync_generation = None
+
+    def sync(self):
+        """Refresh the local torrent cache, only fetching recently active torrents when possible."""
+        now = time.monotonic()
+        if (
+            self._sync_generation != self.session.generation
+            # Changes older than the window are lost, so catch up with a full fetch
+            or now - self._last_sync >= RECENTLY_ACTIVE_WINDOW
+            or now - self._last_full_sync >= self.full_sync_interval
+        ):
+            torrents = self.session.call("torrent-get", lambda client: client.get_torrents(arguments=self.torrent_arguments))
+            self._torrents = {t.id: t for t in torrents}
+            self._sync_generation = self.session.generation
+            self._last_full_sync = now
+        else:
+            active, removed = self.session.call(
+                "torrent-get recently-active",
+                lambda client: client.get_recently_active_torrents(arguments=self.torrent_arguments)
             )
+            for t in active:
+                self._torrents[t.id] = t
+            for torrent_id in removed:
+                self._torrents.pop(torrent_id, None)
+            if self._sync_generation != self.session.generation:
+                # Reconnected in the middle, ids may have been reassigned
+                self._sync_generation = None
+        self._last_sync = now
+        return self._torrents.values()
+
+    def fetch_torrents(self):
+        """The torrent list, None if it couldn't be fetched."""
+        try:
+            if self.incremental:
+                return self.sync()
+            return self.session.call("torrent-get", lambda client: client.get_torrents(arguments=self.torrent_arguments))
         except Exception as e:
-            logger.error(f"[{self.name}] Can not get client torrents: {e}")
-            torrents = []
+            if not isinstance(e, CircuitOpenError):
+                logger.error(f"[{self.name}] Can not get client torrents: {e}")
+            self._sync_generation = None
+            return None
 
-        counter = Counter()
-        metrics = []
+    def get_torrent_metrics(self, torrents):
+        if torrents is None:
+            return []
+
+        table = TorrentTable()
         for t in torrents:
-            tracker = urlparse(
-                next(
-                    (
-                        _t.get("announce", "https://unknown.tracker")
-                        for _t in t.fields["trackerStats"]
-                    ),
-                    "https://unknown.tracker",
-                )
-            ).netloc
+            trackers = t.fields["trackers"]
+            tracker = self.trackers.resolve(trackers[0].get("announce", UNKNOWN_TRACKER) if trackers else UNKNOWN_TRACKER)
             category = "Uncategorized"
             if "labels" in t.fields:
                 category = next((l for l in t.fields["labels"]), "Uncategorized")
-            counter[
-                TorrentStat(
-                    TorrentStatus.parse_tr(t.status).value,
-                    category,
-                    tracker,
-                )
-            ] += 1
-            metrics.append(
-                {
-                    "name": "downloader_tracker_torrent_upload_bytes_total",
-                    "type": "counter",
-                    "value": t.fields["uploadedEver"],
-                    "labels": {
-                        "torrent_name": t.name,
-                        "tracker": tracker,
-                    },
-                    "help": f"Data uploaded to tracker {tracker} for torrent {t.name}",
-                }
-            )
-            metrics.append(
-                {
-                    "name": "downloader_tracker_torrent_download_bytes_total",
-                    "type": "counter",
-                    "value": t.fields["downloadedEver"],
-                    "labels": {
-                        "torrent_name": t.name,
-                        "tracker": tracker,
-                    },
-                    "help": f"Data downloaded to tracker {tracker} for torrent {t.name}",
-                }
+            table.append(
+                t.name,
+                TorrentStatus.parse_tr(t.status, self.states).value,
+                category,
+                tracker,
+                t.fields["uploadedEver"],
+                t.fields["downloadedEver"],
+                t.fields.get("activityDate"),
+                t.fields.get("hashString", t.id),
             )
-
-        for t, count in counter.items():
-            metrics.append(
-                {
-                    "name": "downloader_torrents_count",
-                    "value": count,
-                    "labels": {
-                        "status": t.status,
-                        "category": t.category,
-                        "tracker": t.tracker,
-                    },
-                    "help": f"Number of torrents in status {t.status} under category {t.category} with tracker {t.tracker}",
-                }
-            )
-        return metrics
+        return self.table_metrics(table)
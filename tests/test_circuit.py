@@ -0,0 +1,82 @@
+import pytest
+
+from downloader_exporter import circuit
+from downloader_exporter.circuit import CircuitBreaker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class NoJitter:
+    @staticmethod
+    def uniform(a, b):
+        return b
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(circuit, "time", clock)
+    monkeypatch.setattr(circuit, "random", NoJitter)
+    return clock
+
+
+def test_opens_after_failures(clock):
+    breaker = CircuitBreaker("d", failures=3, backoff=10)
+    breaker.failure()
+    breaker.failure()
+    assert not breaker.is_open and breaker.allow()
+
+    breaker.failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+    assert breaker.remaining() == 10
+
+
+def test_half_open_failure_doubles_backoff(clock):
+    breaker = CircuitBreaker("d", failures=2, backoff=10)
+    breaker.failure()
+    breaker.failure()
+
+    clock.now += 10
+    assert breaker.allow()
+    # A single failed attempt is enough to open it again, for twice as long
+    breaker.failure()
+    assert not breaker.allow()
+    assert breaker.remaining() == 20
+
+
+def test_backoff_is_capped(clock):
+    breaker = CircuitBreaker("d", failures=1, backoff=10, max_backoff=25)
+    for _ in range(4):
+        breaker.failure()
+        clock.now += breaker.remaining()
+    breaker.failure()
+    assert breaker.remaining() == 25
+
+
+def test_success_closes(clock):
+    breaker = CircuitBreaker("d", failures=1, backoff=10)
+    breaker.failure()
+    clock.now += 10
+    breaker.success()
+
+    assert not breaker.is_open
+    assert breaker.allow()
+    assert breaker.remaining() == 0
+    # The failure count and the backoff start over
+    breaker.failure()
+    assert breaker.remaining() == 10
+
+
+def test_zero_failures_disables(clock):
+    breaker = CircuitBreaker.from_config("d", {"circuit_failures": 0})
+    for _ in range(100):
+        breaker.failure()
+    assert not breaker.is_open
+    assert breaker.allow()
@@ -0,0 +1,32 @@
+import pytest
+
+from downloader_exporter.constants import TorrentStatus
+
+
+def test_states_are_matched_exactly():
+    # Substrings of other states must not win, e.g. "download" in "download pending"
+    assert TorrentStatus.parse_tr("download pending") is TorrentStatus.QUEUED
+    assert TorrentStatus.parse_tr("seed pending") is TorrentStatus.QUEUED
+    assert TorrentStatus.parse_qb("stalledUP") is TorrentStatus.STALLED
+    assert TorrentStatus.parse_qb("forcedMetaDL") is TorrentStatus.DOWNLOADING
+    assert TorrentStatus.parse_de("Seeding") is TorrentStatus.UPLOADING
+
+
+def test_unknown_state():
+    assert TorrentStatus.parse_qb("UP") is TorrentStatus.UNKNOWN
+    assert TorrentStatus.parse_de("seeding") is TorrentStatus.UNKNOWN
+
+
+def test_states_overrides():
+    table = TorrentStatus.states("qBittorrent", {"stalledUP": "uploading", "newState": "Paused"})
+
+    assert TorrentStatus.parse_qb("stalledUP", table) is TorrentStatus.UPLOADING
+    assert TorrentStatus.parse_qb("newState", table) is TorrentStatus.PAUSED
+    assert TorrentStatus.parse_qb("stalledDL", table) is TorrentStatus.STALLED
+    # The built-in table is left alone
+    assert TorrentStatus.parse_qb("stalledUP") is TorrentStatus.STALLED
+
+
+def test_invalid_override():
+    with pytest.raises(ValueError):
+        TorrentStatus.states("Transmission", {"stopped": "Sleeping"})
@@ -0,0 +1,93 @@
+import zlib
+
+import pytest
+from deluge_client import rencode
+
+from downloader_exporter.deluge_rpc import (
+    HEADER,
+    PROTOCOL_VERSION,
+    RPC_ERROR,
+    RPC_EVENT,
+    RPC_RESPONSE,
+    DelugeRemoteError,
+    call_pipelined,
+)
+
+
+def frame(*message):
+    body = zlib.compress(rencode.dumps(message))
+    return HEADER.pack(PROTOCOL_VERSION, len(body)) + body
+
+
+class FakeSocket:
+    """Answers with ``responses(request_ids)`` once the requests are sent, a few bytes per recv."""
+
+    def __init__(self, responses, chunk=7):
+        self.responses = responses
+        self.chunk = chunk
+        self.data = b""
+
+    def sendall(self, payload):
+        request_ids = []
+        while payload:
+            _, length = HEADER.unpack_from(payload)
+            end = HEADER.size + length
+            (request,) = rencode.loads(zlib.decompress(payload[HEADER.size:end]))
+            request_ids.append(request[0])
+            payload = payload[end:]
+        self.data = b"".join(self.responses(request_ids))
+
+    def recv(self, size):
+        data, self.data = self.data[:min(size, self.chunk)], self.data[min(size, self.chunk):]
+        return data
+
+
+class FakeClient:
+    def __init__(self, sock):
+        self.request_id = 0
+        self._socket = sock
+        self.decode_utf8 = True
+
+
+CALLS = [("daemon.info", (), {}), ("core.get_session_status", (["upload_rate"],), {})]
+
+
+def test_out_of_order_responses():
+    client = FakeClient(FakeSocket(lambda ids: [
+        frame(RPC_RESPONSE, ids[1], {"upload_rate": 5}),
+        frame(RPC_RESPONSE, ids[0], "2.1.1"),
+    ]))
+
+    assert call_pipelined(client, CALLS) == ["2.1.1", {"upload_rate": 5}]
+
+
+def test_events_and_unknown_ids_are_skipped():
+    client = FakeClient(FakeSocket(lambda ids: [
+        frame(RPC_EVENT, "TorrentAddedEvent", ["abc"]),
+        frame(RPC_RESPONSE, ids[0], "2.1.1"),
+        frame(RPC_RESPONSE, 9999, "late answer"),
+        frame(RPC_RESPONSE, ids[1], {"upload_rate": 5}),
+    ]))
+
+    assert call_pipelined(client, CALLS) == ["2.1.1", {"upload_rate": 5}]
+
+
+def test_errors_and_sizes_per_call():
+    sizes = []
+    client = FakeClient(FakeSocket(lambda ids: [
+        frame(RPC_ERROR, ids[0], "BadLoginError", ["denied"], ""),
+        frame(RPC_RESPONSE, ids[1], {"upload_rate": 5}),
+    ]))
+
+    results = call_pipelined(client, CALLS, lambda method, size: sizes.append(method))
+
+    assert isinstance(results[0], DelugeRemoteError)
+    assert results[1] == {"upload_rate": 5}
+    assert sizes == ["daemon.info", "core.get_session_status"]
+
+
+def test_closed_connection():
+    client = FakeClient(FakeSocket(lambda ids: [frame(RPC_RESPONSE, ids[0], "2.1.1")]))
+
+    with pytest.raises(EOFError):
+        call_pipelined(client, CALLS)
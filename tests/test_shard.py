@@ -0,0 +1,44 @@
+import pytest
+
+from downloader_exporter.shard import Shard
+
+NAMES = [f"downloader{i}" for i in range(200)]
+
+
+def owners(count):
+    shard = Shard(0, count)
+    return {name: shard.owner(name) for name in NAMES}
+
+
+def test_owner_is_stable():
+    assert owners(4) == owners(4)
+    # Every replica agrees, whichever index it is
+    assert all(Shard(index, 4).owner(name) == owner for name, owner in owners(4).items() for index in range(4))
+
+
+def test_every_name_has_one_owner():
+    config = {name: {} for name in NAMES}
+    selected = [Shard(index, 3).select(config) for index in range(3)]
+
+    assert sum(len(s) for s in selected) == len(NAMES)
+    assert set().union(*selected) == set(NAMES)
+
+
+def test_adding_a_shard_only_moves_names_to_it():
+    before, after = owners(4), owners(5)
+    moved = [name for name in NAMES if before[name] != after[name]]
+
+    assert all(after[name] == 4 for name in moved)
+    # About a fifth of the names, far from a full reshuffle
+    assert 0 < len(moved) < len(NAMES) / 3
+
+
+def test_removing_a_shard_only_moves_its_names():
+    before, after = owners(5), owners(4)
+
+    assert all(before[name] == after[name] for name in NAMES if before[name] != 4)
+
+
+def test_invalid_index():
+    with pytest.raises(ValueError):
+        Shard(3, 3)
@@ -0,0 +1,31 @@
+from downloader_exporter.torrents import TorrentTable, TrackerTotals
+
+
+def make_table(*torrents):
+    table = TorrentTable()
+    for key, tracker, category, uploaded, downloaded in torrents:
+        table.append(key, "Uploading", category, tracker, uploaded, downloaded, key=key)
+    return table
+
+
+def test_tracker_totals_survive_failed_poll():
+    totals = TrackerTotals()
+    torrents = [("a", "t1", "c", 100, 10), ("b", "t1", "c", 50, 5)]
+
+    before, _ = totals.update(make_table(*torrents))
+    # A failed poll shows up as an empty torrent list
+    during, _ = totals.update(make_table())
+    after, _ = totals.update(make_table(*torrents))
+
+    assert before[("t1", "c")] == [150, 15]
+    assert during[("t1", "c")] == [150, 15]
+    assert after[("t1", "c")] == [150, 15]
+
+
+def test_tracker_totals_keep_removed_torrents():
+    totals = TrackerTotals()
+    totals.update(make_table(("a", "t1", "c", 100, 10), ("b", "t1", "c", 50, 5)))
+
+    result, _ = totals.update(make_table(("a", "t1", "c", 120, 10)))
+
+    assert result[("t1", "c")] == [170, 15]